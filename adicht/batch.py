@@ -0,0 +1,236 @@
+# coding: utf-8
+
+import os
+import glob
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_NO_FILES = 2
+
+# the reporter of a worker process of run_batch as (output dir, mode, assets, reporter), see _initialize_worker
+_worker_reporter = None
+
+
+def expand_data_files(patterns):
+    """Expand the given file names/glob patterns to absolute paths (keeping order, without duplicates)."""
+    result = []
+
+    for pattern in patterns:
+        for entry in sorted(glob.glob(pattern)) or [pattern]:
+            # the notebook kernels do not share the working directory
+            entry = os.path.abspath(entry)
+            if entry not in result:
+                result.append(entry)
+
+    return result
+
+
+def evaluate_file(data_file, streaming=False):
+    """Parse the given file and evaluate the stimulations of all channels (of all blocks).
+
+    In streaming mode the file is loaded lazily and the channel data is
+    read in chunks, so memory usage is bounded by the longest stimulation.
+    """
+    from adicht.data import ADichtMatlabFile
+    from adicht.evaluation import iter_evaluated_stimulations
+    from adicht.parallel import get_evaluated_channels
+
+    with ADichtMatlabFile(data_file, lazy=streaming) as data_file:
+        channels = [channel for block in data_file.blocks for channel in block.channels]
+
+        if streaming:
+            stimulation_count = sum(
+                sum(1 for _ in iter_evaluated_stimulations(channel)) for channel in channels if channel.sample_count)
+        else:
+            stimulation_count = sum(len(entry) for entry in get_evaluated_channels(data_file, channels))
+
+        return '%d channels, %d blocks, %d stimulations' % (
+            len(data_file.channels), len(data_file.blocks), stimulation_count)
+
+
+def get_default_jobs(notebooks=False):
+    """Return the number of jobs which keeps all cores busy.
+
+    With notebooks, every job executes the kernels of its reporter.
+    """
+    cores = os.cpu_count() or 1
+    if notebooks:
+        from adicht.report.kernels import KERNELS_PER_REPORTER
+
+        return max(1, cores // KERNELS_PER_REPORTER)
+    return cores
+
+
+def create_reporter(output_dir, mode=None, assets=None):
+    from adicht.report import Reporter
+
+    return Reporter(output_dir, mode=mode or Reporter.KERNEL_MODE, assets=assets or Reporter.INLINE_ASSETS)
+
+
+def report_file(data_file, output_dir, mode=None, force=False, assets=None):
+    """Generate all (outdated) reports for the given file.
+
+    Within the worker processes of run_batch, the reporter (and its warm
+    kernels) of the process is used, otherwise a new one.
+    """
+    if _worker_reporter is not None and _worker_reporter[:3] == (output_dir, mode, assets):
+        _worker_reporter[3].generate_report(data_file, force)
+    else:
+        with create_reporter(output_dir, mode, assets) as reporter:
+            reporter.generate_report(data_file, force)
+
+    return 'report written to %s' % output_dir
+
+
+def export_file(data_file, export_dir, export_format=None):
+    """Write the evaluation results of the given file to the dataset in export_dir."""
+    from adicht.export import export_file as export
+
+    paths = export(data_file, export_dir, export_format)
+
+    return 'results exported to %s' % ', '.join(os.path.relpath(entry, export_dir) for entry in paths)
+
+
+def process_file(data_file, output_dir=None, mode=None, force=False, streaming=False, profile=False,
+                 trace_dir=None, export_dir=None, export_format=None, assets=None):
+    """Process a single file within a worker process.
+
+    Returns a tuple of the file name, a success flag and a status message.
+    Without an output or export directory, the file is only evaluated. With
+    profile (or a trace_dir), the stage timings are appended to the message.
+    """
+    from adicht import instrumentation
+
+    if not os.path.isfile(data_file):
+        return data_file, False, 'file not found'
+
+    if profile or trace_dir:
+        instrumentation.enable(trace_dir)
+
+    lines = []
+    try:
+        with instrumentation.profile(os.path.splitext(os.path.basename(data_file))[0], lines.append):
+            if output_dir is not None:
+                lines.append(report_file(data_file, output_dir, mode, force, assets))
+            if export_dir is not None:
+                lines.append(export_file(data_file, export_dir, export_format))
+            if not lines:
+                lines.append(evaluate_file(data_file, streaming))
+        return data_file, True, '\n'.join(lines)
+    except Exception:
+        return data_file, False, traceback.format_exc()
+
+
+def run_batch(data_files, output_dir=None, jobs=None, log_callback=None, mode=None, force=False,
+              streaming=False, profile=False, trace_dir=None, export_dir=None, export_format=None, assets=None):
+    """Process the given files in a pool of jobs processes (by default see get_default_jobs).
+
+    Every process keeps one reporter for all of its files. Returns the
+    results of process_file in the order of the given files.
+    """
+    results = {}
+
+    if jobs is None:
+        jobs = get_default_jobs(output_dir is not None and mode != 'direct')
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_initialize_worker,
+                             initargs=(output_dir, mode, assets)) as executor:
+        futures = [executor.submit(process_file, entry, output_dir, mode, force, streaming, profile, trace_dir,
+                                   export_dir, export_format, assets)
+                   for entry in data_files]
+
+        for future in as_completed(futures):
+            data_file, success, message = future.result()
+            results[data_file] = (data_file, success, message)
+
+            if log_callback:
+                log_callback('%s %s: %s' % ('OK' if success else 'FAILED', data_file, message))
+
+    return [results[entry] for entry in data_files]
+
+
+def _initialize_worker(output_dir, mode, assets):
+    """Create the reporter shared by the files of the worker process, closed when the process exits."""
+    global _worker_reporter
+
+    if output_dir is None:
+        return
+
+    from multiprocessing.util import Finalize
+
+    reporter = create_reporter(output_dir, mode, assets)
+    _worker_reporter = (output_dir, mode, assets, reporter)
+    # atexit handlers do not run in worker processes, finalizers with a priority do
+    Finalize(reporter, reporter.close, exitpriority=10)
+
+
+def create_argument_parser():
+    parser = argparse.ArgumentParser(
+        prog='adicht-eval batch',
+        description='Evaluate LabChart matlab exports without the GUI.')
+    parser.add_argument('files', nargs='+',
+                        help='matlab files to evaluate (glob patterns are expanded)')
+    parser.add_argument('-o', '--output-dir',
+                        help='directory to write the reports to '
+                             '(if omitted, the files are only evaluated)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of worker processes (default: number of cores, divided by '
+                             'the kernels of a job when executing notebooks)')
+    parser.add_argument('--channel-jobs', type=int,
+                        help='number of worker processes evaluating the channels of a file '
+                             '(default: 1, see ADICHT_EVALUATION_WORKERS)')
+    parser.add_argument('--plot-jobs', type=int,
+                        help='number of worker processes rendering the plots of a report '
+                             '(default: 1, see ADICHT_PLOT_WORKERS)')
+    parser.add_argument('--direct', action='store_const', dest='mode', const='direct', default='kernel',
+                        help='render the reports in-process instead of executing notebooks')
+    parser.add_argument('--external-assets', action='store_const', dest='assets', const='external',
+                        default='inline',
+                        help='write the images of the HTML reports to the assets directory of the '
+                             'output directory instead of inlining them')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='regenerate reports even if they are up to date')
+    parser.add_argument('--streaming', action='store_true',
+                        help='read the channel data in chunks when only evaluating '
+                             '(for recordings larger than memory)')
+    parser.add_argument('--export', dest='export_dir', metavar='DATASET_DIR',
+                        help='add the evaluation results (stimulations, channels, markers) '
+                             'to the columnar dataset in this directory')
+    parser.add_argument('--export-format', choices=['parquet', 'feather', 'csv'],
+                        help='file format of the exported tables '
+                             '(default: parquet if pyarrow is installed, csv otherwise)')
+    parser.add_argument('--profile', action='store_true',
+                        help='log the duration and peak memory of the processing stages')
+    parser.add_argument('--trace-dir',
+                        help='write a Chrome trace file per data file to this directory '
+                             '(implies --profile)')
+    return parser
+
+
+def main(args=None):
+    options = create_argument_parser().parse_args(args)
+
+    data_files = expand_data_files(options.files)
+    if not data_files:
+        return EXIT_NO_FILES
+
+    if options.channel_jobs:
+        # reaches the worker processes and the notebook kernels
+        os.environ['ADICHT_EVALUATION_WORKERS'] = str(options.channel_jobs)
+    if options.plot_jobs:
+        os.environ['ADICHT_PLOT_WORKERS'] = str(options.plot_jobs)
+
+    jobs = max(options.jobs, 1) if options.jobs is not None else None
+
+    results = run_batch(data_files, options.output_dir, jobs, print, options.mode, options.force,
+                        options.streaming, options.profile, options.trace_dir, options.export_dir,
+                        options.export_format, options.assets)
+    failed = [entry for entry in results if not entry[1]]
+
+    print('%d of %d files processed successfully' % (len(results) - len(failed), len(results)))
+
+    return EXIT_FAILED if failed else EXIT_OK
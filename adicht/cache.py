@@ -0,0 +1,213 @@
+# coding: utf-8
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+import numpy
+
+
+# bump this whenever the parsing of the matlab files changes
+PARSER_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'ADICHT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'adicht-eval'))
+DEFAULT_MAX_SIZE = int(os.environ.get('ADICHT_CACHE_SIZE', 10 * 1024 ** 3))
+
+ENTRY_DIR = 'entries'
+DIGEST_DIR = 'digests'
+
+_default_cache = None
+
+
+def file_digest(filename, chunk_size=1024 * 1024):
+    """Calculate the hex digest of the content of the given file."""
+    digest = hashlib.blake2b(digest_size=20)
+
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def get_file_stamp(filename):
+    """Return size and modification time (ns) of the file, which change whenever its content does."""
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_memoized_digest(filename, lookup, remember=None, hash_file=True):
+    """Return the digest of the file, reusing a remembered one while the stamp of the file is the same.
+
+    Hashing big files takes a while. lookup(stamp) returns the digest
+    remembered for the file stamp (or None), remember(stamp, digest) is
+    called with a newly calculated digest. Without hash_file, None is
+    returned instead of hashing the file.
+    """
+    stamp = get_file_stamp(filename)
+
+    digest = lookup(stamp)
+    if digest is None and hash_file:
+        digest = file_digest(filename)
+        if remember is not None:
+            remember(stamp, digest)
+
+    return digest
+
+
+def get_default_cache():
+    """Return the cache used by ADichtMatlabFile if no cache is given explicitly.
+
+    Returns None if caching is disabled via ADICHT_CACHE=0.
+    """
+    global _default_cache
+
+    if os.environ.get('ADICHT_CACHE', '1').lower() in ('0', 'off', 'no', 'false'):
+        return None
+
+    if _default_cache is None:
+        _default_cache = ParsedFileCache()
+    return _default_cache
+
+
+class ParsedFileCache(object):
+    """On-disk cache for the variables of parsed matlab files.
+
+    Every variable is stored as separate .npy file, so cached files can be
+    opened as memory maps instead of being parsed again. Entries are keyed by
+    the content hash of the source file and the parser version. If the cache
+    grows beyond max_size, the least recently used entries are removed.
+
+    Errors of the cache directory (not writable, removed by another
+    process, ...) are treated as cache misses, the cache never makes
+    loading a file fail.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self._directory = directory
+        self._max_size = max_size
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def get_key(self, filename, hash_file=True):
+        """Return the key of the file, None if its digest is not remembered and hash_file is not set."""
+        digest = self._get_digest(filename, hash_file)
+        return '%s-%d' % (digest, PARSER_VERSION) if digest is not None else None
+
+    def load(self, filename, hash_file=True):
+        """Return the cached variables of the given file or None if not cached.
+
+        Without hash_file, the file is only looked up if its digest is
+        remembered already (hashing reads the whole file).
+        """
+        try:
+            key = self.get_key(filename, hash_file)
+            if key is None:
+                return None
+
+            entry_dir = self._get_entry_dir(key)
+            if not os.path.isdir(entry_dir):
+                return None
+
+            # mark as recently used
+            os.utime(entry_dir)
+
+            return {
+                os.path.splitext(entry)[0]: numpy.load(os.path.join(entry_dir, entry),
+                                                       mmap_mode='r', allow_pickle=False)
+                for entry in os.listdir(entry_dir) if entry.endswith('.npy')
+            }
+        except OSError:
+            # not accessible or evicted by another process meanwhile
+            return None
+
+    def store(self, filename, content):
+        """Store the variables of the given file (if they can be stored without pickling)."""
+        entry_dir = self._get_entry_dir(self.get_key(filename))
+
+        if os.path.isdir(entry_dir):
+            return
+
+        try:
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        except OSError:
+            return
+
+        try:
+            for name, value in content.items():
+                if name.startswith('__'):
+                    continue
+                numpy.save(os.path.join(tmp_dir, '%s.npy' % name), value, allow_pickle=False)
+            os.rename(tmp_dir, entry_dir)
+        except (ValueError, OSError):
+            # unsupported content or another process stored the entry meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits max_size."""
+        entries_dir = os.path.join(self._directory, ENTRY_DIR)
+        if not os.path.isdir(entries_dir):
+            return
+
+        entries = []
+        for entry in os.listdir(entries_dir):
+            path = os.path.join(entries_dir, entry)
+            try:
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except FileNotFoundError:
+                # evicted by another process meanwhile
+                continue
+
+        total_size = sum(entry[1] for entry in entries)
+
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def clear(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _get_entry_dir(self, key):
+        return os.path.join(self._directory, ENTRY_DIR, key)
+
+    def _get_digest(self, filename, hash_file=True):
+        # the digest is remembered in a memo file per path
+        memo_file = os.path.join(
+            self._directory, DIGEST_DIR,
+            hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest())
+
+        def lookup(stamp):
+            try:
+                with open(memo_file, 'r') as f:
+                    memo_stamp, _, digest = f.read().rpartition(' ')
+            except OSError:
+                return None
+            return digest if memo_stamp == '%d %d' % tuple(stamp) else None
+
+        def remember(stamp, digest):
+            try:
+                os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+                tmp_file = '%s.%d' % (memo_file, os.getpid())
+                with open(tmp_file, 'w') as f:
+                    f.write('%d %d %s' % (stamp[0], stamp[1], digest))
+                os.replace(tmp_file, memo_file)
+            except OSError:
+                # the digest is calculated again next time
+                pass
+
+        return get_memoized_digest(filename, lookup, remember, hash_file)
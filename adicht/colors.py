@@ -35,8 +35,9 @@ COLORS = [
     '#ccffcc',
 ]
 
-def get_random_color(already_used_ones=None):
+def get_random_color(already_used_ones=None, generator=None):
+    """Return a random color, generator is a random.Random to use instead of the global one."""
     if already_used_ones is None:
         already_used_ones = []
 
-    return random.choice(COLORS)
\ No newline at end of file
+    return (generator or random).choice(COLORS)
\ No newline at end of file
@@ -1,10 +1,15 @@
 # coding: utf-8
 
+import re
 from enum import Enum
-from collections import defaultdict
 
-from scipy.io import loadmat
-from numpy import array, stack
+from numpy import arange, array, dtype, empty, flatnonzero, integer, ones, ravel, stack, unique
+
+from adicht.cache import get_default_cache
+from adicht.instrumentation import stage, staged
+from adicht.markers import MarkerCategory, get_default_classifier, normalize_text
+from adicht.matfile import HEADER_VARIABLES, MatlabContent, ArrayDataSource, \
+    load_variables, open_data_source
 
 
 class MarkerType(Enum):
@@ -13,80 +18,290 @@ class MarkerType(Enum):
 
 
 class Marker(object):
-    """This class represents a marker (or comment in the the adicht wording)."""
+    """This class represents a marker (or comment in the the adicht wording).
+    
+    Markers are lightweight views to a row of a MarkerTable. A time offset
+    can be applied to a marker without modifying the table.
+    """
+    
+    __slots__ = ('_table', '_row', '_time_offset')
 
-    def __init__(self, channel, block, position, marker_type, text, tickrate=1):
-        self._channel = channel
-        self._block = block
-        self._position = position
-        self._type = MarkerType(marker_type)
-        self._text = text
-        self._tickrate = tickrate
-        
-        self._timed_position = None
-        
-        self._generate_time_information()
+    def __init__(self, table, row, time_offset=0.0):
+        self._table = table
+        self._row = row
+        self._time_offset = time_offset
+    
+    def __eq__(self, other):
+        return isinstance(other, Marker) and (self.index, self._time_offset) == (other.index, other._time_offset)
+    
+    def __hash__(self):
+        return hash((self.index, self._time_offset))
+    
+    def __copy__(self):
+        return Marker(self._table, self._row, self._time_offset)
+    
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+    
+    def __repr__(self):
+        return '<Marker %d %r at %fs>' % (self.index, self.text, self.timed_position)
+    
+    @property
+    def index(self):
+        """Read only access to the index of the marker within the file."""
+        return int(self._table.records['index'][self._row])
     
     @property
     def channel(self):
         """Read only access to the channel the marker was set to."""
-        return self._channel
+        return int(self._table.records['channel'][self._row])
     
     @property
     def block(self):
         """Read only access to the block the marker was set to."""
-        return self._block
+        return int(self._table.records['block'][self._row])
     
     @property
     def position(self):
         """Read only access to the position the marker was set to."""
-        return self._position
+        return int(self._table.records['position'][self._row])
     
     @property
     def type(self):
         """Read only access to the marker type."""
-        return self._type
+        return MarkerType(int(self._table.records['type'][self._row]))
     
     @property
     def text(self):
         """Read only access to the marker's text."""
-        return self._text
+        return str(self._table.texts[self._table.records['text_id'][self._row]])
+    
+    @property
+    def normalized_text(self):
+        """Read only access to the marker's text in lower case without surrounding whitespace."""
+        return str(self._table.normalized_texts[self._table.records['text_id'][self._row]])
+    
+    @property
+    def category(self):
+        """Read only access to the marker's category (according to the default classifier)."""
+        return MarkerCategory(int(self._table.get_text_categories()[self._table.records['text_id'][self._row]]))
     
     @property
     def timed_position(self):
         """Read only access to the marker time defined by position and tick rate."""
-        return self._timed_position
+        return float(self._table.records['time'][self._row]) - self._time_offset
 
+    def get_sample_index(self, samplerate, time_offset=0.0):
+        """Return the index of the sample (at the given sample rate) the marker was set to.
+        
+        If tick rate and sample rate differ, the nearest sample is returned.
+        """
+        return int(round((self.timed_position - time_offset) * samplerate))
+    
     def apply_time_offest(self, offset):
-        self._timed_position -= offset
+        self._time_offset += offset
+
+
+class MarkerTable(object):
+    """This class represents a set of markers as numpy structured array.
+    
+    The marker texts are interned, every row only refers to the id of its
+    text. Subsets created by indexing or select share the texts (and their
+    classification) with their parent table.
+    """
+    
+    DTYPE = dtype([
+        ('index', 'i8'),
+        ('channel', 'i4'),
+        ('block', 'i4'),
+        ('position', 'i8'),
+        ('type', 'i1'),
+        ('text_id', 'i4'),
+        ('time', 'f8'),
+    ])
+    
+    def __init__(self, records, texts, normalized_texts=None, text_categories=None):
+        self._records = records
+        self._texts = texts
+        self._normalized_texts = normalized_texts
+        # classifier -> category value per text id, shared with the subsets
+        self._text_categories = text_categories if text_categories is not None else {}
+        
+        if normalized_texts is None:
+            self._normalized_texts = array([normalize_text(entry) for entry in texts], dtype=str)
+    
+    @classmethod
+    def from_content(cls, com, comtext, tickrate):
+        """Create the table from the 'com' and 'comtext' variables of a matlab file.
+        
+        tickrate is either a single tick rate or an array with the tick rate of
+        every block, the marker positions are relative to the start of their
+        block.
+        """
+        # -1 for all indices as adicht uses 1 based arrays
+        com = array(com, dtype=float).reshape(-1, 5).astype(int) - [1, 1, 1, 0, 1]
+        texts, text_ids = unique([entry.strip() for entry in comtext], return_inverse=True)
+        
+        records = empty(len(com), dtype=cls.DTYPE)
+        records['index'] = arange(len(com))
+        records['channel'] = com[:, 0]
+        records['block'] = com[:, 1]
+        records['position'] = com[:, 2]
+        records['type'] = com[:, 3]
+        records['text_id'] = ravel(text_ids)[com[:, 4]]
+        tickrates = ravel(array(tickrate, dtype=float))
+        records['time'] = records['position'] / tickrates[records['block'] if tickrates.size > 1 else 0]
+        
+        return cls(records, texts)
+    
+    def __len__(self):
+        return len(self._records)
     
-    def _generate_time_information(self):
-        self._timed_position = self.position / self._tickrate
+    def __iter__(self):
+        for row in range(len(self._records)):
+            yield Marker(self, row)
+    
+    def __getitem__(self, item):
+        if isinstance(item, (int, integer)):
+            return Marker(self, range(len(self._records))[item])
+        return MarkerTable(self._records[item], self._texts, self._normalized_texts, self._text_categories)
+    
+    @property
+    def records(self):
+        """Read only access to the underlying structured array."""
+        return self._records
+    
+    @property
+    def texts(self):
+        """Read only access to the distinct marker texts (indexed by text id)."""
+        return self._texts
+    
+    @property
+    def normalized_texts(self):
+        """Read only access to the distinct normalized marker texts (indexed by text id)."""
+        return self._normalized_texts
+    
+    @property
+    def times(self):
+        """Read only access to the marker times."""
+        return self._records['time']
+    
+    def get_texts(self):
+        """Return the text of every marker of the table."""
+        return self._texts[self._records['text_id']]
+    
+    def get_normalized_texts(self):
+        """Return the normalized text of every marker of the table."""
+        return self._normalized_texts[self._records['text_id']]
+    
+    def get_text_categories(self, classifier=None):
+        """Return the category value of every distinct text (indexed by text id).
+        
+        Every text is classified once per classifier.
+        """
+        if classifier is None:
+            classifier = get_default_classifier()
+        
+        if classifier not in self._text_categories:
+            self._text_categories[classifier] = classifier.classify_texts(self._normalized_texts)
+        return self._text_categories[classifier]
+    
+    def get_categories(self, classifier=None):
+        """Return the category value of every marker of the table."""
+        return self.get_text_categories(classifier)[self._records['text_id']]
+    
+    def index(self, marker):
+        """Return the row of the given marker within the table."""
+        rows = flatnonzero(self._records['index'] == marker.index)
+        if not len(rows):
+            raise ValueError('%r is not in table' % marker)
+        return int(rows[0])
+    
+    def match_texts(self, patterns):
+        """Return a mask of the text ids whose normalized text matches any of the patterns."""
+        if isinstance(patterns, (str, re.Pattern)):
+            patterns = [patterns]
+        patterns = [re.compile(entry) if isinstance(entry, str) else entry for entry in patterns]
+        
+        return array([
+            any(pattern.match(text) for pattern in patterns)
+            for text in self._normalized_texts
+        ], dtype=bool)
+    
+    def select(self, channel=None, block=None, text=None, start=None, stop=None, category=None):
+        """Return the markers matching all of the given criteria as new table.
+        
+        text may be a (compiled) regular expression or a list of them, it is
+        matched against the normalized texts. start and stop limit the marker
+        times to the interval [start, stop). category is a MarkerCategory
+        (according to the default classifier).
+        """
+        mask = ones(len(self._records), dtype=bool)
+        
+        if channel is not None:
+            mask &= self._records['channel'] == channel
+        if block is not None:
+            mask &= self._records['block'] == block
+        if text is not None:
+            mask &= self.match_texts(text)[self._records['text_id']]
+        if start is not None:
+            mask &= self._records['time'] >= start
+        if stop is not None:
+            mask &= self._records['time'] < stop
+        if category is not None:
+            mask &= self.get_categories() == MarkerCategory(category).value
+        
+        return self[mask]
 
     
 class Channel(object):
-    """This class represents a single channel."""
+    """This class represents a single channel (within a single block)."""
     
-    def __init__(self, data, rangemin, rangemax, samplerate, title, unit, offset, markers=None):
+    def __init__(self, data, rangemin, rangemax, samplerate, title, unit, offset, markers=None,
+                 source=None, data_range=None, block=0):
         self._data = data
+        self._block = block
+        self._source = source
+        self._data_range = data_range
         self._rangemin = rangemin
         self._rangemax = rangemax
         self._samplerate = samplerate
         self._title = title
         self._unit = unit
         self._offset = offset
-        self._markers = markers or []
+        self._markers = markers if markers is not None else []
         
         self._times = None
         self._timed_data = None
-        
-        self._generate_time_information()
     
     @property
     def data(self):
-        """Read only access to the channel data."""
+        """Read only access to the channel data.
+        
+        If the channel was created with a data source, the data is read on
+        first access.
+        """
+        if self._data is None:
+            self._data = self.read()
         return self._data
     
+    @property
+    def sample_count(self):
+        """Read only access to the number of samples (without loading the data)."""
+        if self._data is None and self._data_range is not None:
+            return self._data_range[1] - self._data_range[0]
+        return len(self.data)
+    
+    @property
+    def block(self):
+        """Read only access to the index of the block the channel data belongs to."""
+        return self._block
+    
+    @property
+    def data_range(self):
+        """Read only access to the [start, stop) range of the channel within the data vector of the file."""
+        return self._data_range
+    
     @property
     def rangemin(self):
         """Read only access to the channel's range minimum."""
@@ -117,14 +332,29 @@ class Channel(object):
         """Read only access to the offset of the first sample (for timing calculations)."""
         return self._offset
     
+    @property
+    def time_offset(self):
+        """Read only access to the time of the first sample (in seconds)."""
+        return self.offset / self.samplerate
+    
     @property
     def times(self):
-        """Read only access to the calculated times of the data points."""
+        """Read only access to the calculated times of the data points.
+        
+        The array is generated on first access and cached afterwards.
+        """
+        if self._times is None:
+            self._times = self.get_times()
         return self._times
     
     @property
     def timed_data(self):
-        """Read only access to a 2D array representing the data with a time axis."""
+        """Read only access to a 2D array representing the data with a time axis.
+        
+        The array is generated on first access and cached afterwards.
+        """
+        if self._timed_data is None:
+            self._timed_data = stack((self.data, self.times))
         return self._timed_data
     
     @property
@@ -135,25 +365,160 @@ class Channel(object):
     def get_marker_value(self, marker):
         return self.data[marker.position]
     
-    def _generate_time_information(self):
-        time_offset = self.offset / self.samplerate
+    def read(self, start=0, stop=None):
+        """Return the data of the samples in [start, stop).
         
-        # generate the time for every data point
-        self._times =  array([
-            time_offset + i / self.samplerate
-            for i in range(len(self.data))
-        ])
+        Reads only the requested range from the data source if the channel
+        data was not loaded yet.
+        """
+        start, stop, _ = slice(start, stop).indices(self.sample_count)
+        if self._data is not None or self._source is None:
+            return self.data[start:stop]
+        with stage('read_data'):
+            return self._source.read(self._data_range[0] + start, self._data_range[0] + stop)
+    
+    def get_sample_index(self, time):
+        """Return the index of the sample nearest to the given time."""
+        index = int(round((time - self.time_offset) * self.samplerate))
+        return min(max(index, 0), self.sample_count - 1)
+    
+    def get_marker_index(self, marker):
+        """Return the index of the sample the given marker was set to."""
+        index = marker.get_sample_index(self.samplerate, self.time_offset)
+        return min(max(index, 0), self.sample_count - 1)
+    
+    def get_time(self, index):
+        """Return the time of the sample at the given index."""
+        return self.time_offset + index / self.samplerate
+    
+    def get_times(self, start=0, stop=None):
+        """Return the times of the samples in the range [start, stop).
         
-        # combine times with data points
-        self._timed_data = stack((self.data, self.times))
+        Only the requested range is generated, the full time axis is never
+        built for this.
+        """
+        start, stop, _ = slice(start, stop).indices(self.sample_count)
+        return self.time_offset + arange(start, stop) / self.samplerate
+    
+    def get_timed_data(self, start=0, stop=None):
+        """Return a 2D array of data and times for the samples in [start, stop)."""
+        start, stop, _ = slice(start, stop).indices(self.sample_count)
+        return stack((self.read(start, stop), self.get_times(start, stop)))
+
+
+class Block(object):
+    """This class represents a block (a continuous recording period) of a file.
+    
+    Every block has its own tick rate, start time and channels. The channels
+    are created on first access, so a single block can be processed without
+    touching the others.
+    """
+    
+    def __init__(self, index, tickrate, start_time, channel_factory, markers):
+        self._index = index
+        self._tickrate = tickrate
+        self._start_time = start_time
+        self._channel_factory = channel_factory
+        self._markers = markers
+        self._channels = None
+    
+    @property
+    def index(self):
+        """Read only access to the index of the block within the file."""
+        return self._index
+    
+    @property
+    def tickrate(self):
+        """Read only access to the tick rate the marker positions of the block refer to."""
+        return self._tickrate
+    
+    @property
+    def start_time(self):
+        """Read only access to the start of the block (as matlab datenum)."""
+        return self._start_time
+    
+    @property
+    def markers(self):
+        """Read only access to the markers of the block."""
+        return self._markers
+    
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = self._channel_factory(self._index)
+        return self._channels
 
 
 class ADichtMatlabFile(object):
-    def __init__(self, filename):
-        self._content = loadmat(filename)
+    """This class represents a LabChart export in the matlab file format.
+    
+    The recording is partitioned into blocks, see blocks. channels gives
+    access to the channels of the first block.
+    
+    In lazy mode only the small header variables are read on creation. The
+    data of a channel is read from the file on first access (and only the
+    range belonging to that channel), markers and channels are built on first
+    access.
+    
+    Completely parsed files are stored in the given cache (by default the
+    cache returned by get_default_cache, pass None to disable caching) and
+    are opened as memory maps from there afterwards.
+    
+    close (or using the file as context manager) closes the data source,
+    lazily loaded files keep the MAT file open until then.
+    """
+
+    def __init__(self, filename, lazy=False, cache=True):
+        self._filename = filename
+        self._lazy = lazy
+        self._markers = None
+        self._blocks = None
+        
+        if cache is True:
+            cache = get_default_cache()
+        
+        with stage('cache_load'):
+            # lazily loaded files are not read completely just to look them up
+            cached_content = cache.load(filename, hash_file=not lazy) if cache else None
+        
+        if cached_content is not None:
+            self._content = cached_content
+            self._data_source = ArrayDataSource(self._content['data'])
+        elif lazy:
+            self._content = MatlabContent(filename, load_variables(filename, HEADER_VARIABLES))
+            self._data_source = None
+        else:
+            self._content = load_variables(filename)
+            self._data_source = ArrayDataSource(self._content['data'])
+            
+            if cache:
+                with stage('cache_store'):
+                    cache.store(filename, self._content)
+        
         self._metadata = self._extract_metadata()
-        self._markers = self._extract_markers()
-        self._channels = self._extract_channels()
+        
+        if not lazy:
+            self._markers = self._extract_markers()
+            self._blocks = self._extract_blocks()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the data source, channel data which is not loaded yet cannot be read afterwards."""
+        if self._data_source is not None:
+            self._data_source.close()
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def lazy(self):
+        return self._lazy
 
     @property
     def raw_content(self):
@@ -163,14 +528,32 @@ class ADichtMatlabFile(object):
     def metadata(self):
         return self._metadata
     
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = self._extract_blocks()
+        return self._blocks
+    
     @property
     def channels(self):
-        return self._channels
+        return self.blocks[0].channels
     
     @property
-    def markers(self):
+    def marker_table(self):
+        if self._markers is None:
+            self._markers = self._extract_markers()
         return self._markers
     
+    @property
+    def markers(self):
+        return self.marker_table
+    
+    @property
+    def data_source(self):
+        if self._data_source is None:
+            self._data_source = open_data_source(self._filename)
+        return self._data_source
+    
     def get_marker_value(self, marker_spec):
         return self.channels[marker_spec['channel']]['data'][marker_spec['offset']]
 
@@ -178,42 +561,51 @@ class ADichtMatlabFile(object):
         return {
             'tickrate': self._content['tickrate'][0][0],
             'blocktimes': self._content['blocktimes'][0][0],
+            'blocks': ravel(self._content['tickrate']).size,
         }
     
-    def _extract_channels(self):
-        result = []
+    def _extract_blocks(self):
+        tickrates = ravel(self._content['tickrate'])
+        blocktimes = ravel(self._content['blocktimes'])
         
-        markers = defaultdict(list)
-        
-        for entry in self.markers:
-            markers[entry.channel].append(entry)
+        return [
+            Block(index, float(tickrates[index]), float(blocktimes[index]), self._extract_channels,
+                  self.marker_table.select(block=index))
+            for index in range(len(tickrates))
+        ]
+    
+    @staged('extract_channels')
+    def _extract_channels(self, block=0):
+        """Create the channels of the given block."""
+        result = []
         
         for channel_number, title in enumerate(self._content['titles']):
-            data_start = int(self._content['datastart'][channel_number][0]) - 1
-            data_end = int(self._content['dataend'][channel_number][0]) - 1
+            data_start = int(self._content['datastart'][channel_number][block]) - 1
+            data_end = int(self._content['dataend'][channel_number][block]) - 1
+            
+            unit_index = int(self._content['unittextmap'][channel_number][block]) - 1
+            
+            # channels which were not recorded in a block have no data range
+            if data_start < 0:
+                data_start = data_end = 0
             
             result.append(Channel(
-                data=self._content['data'][0][data_start:data_end],
-                rangemin=float(self._content['rangemin'][channel_number][0]),
-                rangemax=float(self._content['rangemax'][channel_number][0]),
-                samplerate=float(self._content['samplerate'][channel_number][0]),
+                data=None if self._lazy else self._content['data'][0][data_start:data_end],
+                rangemin=float(self._content['rangemin'][channel_number][block]),
+                rangemax=float(self._content['rangemax'][channel_number][block]),
+                samplerate=float(self._content['samplerate'][channel_number][block]),
                 title=title.strip(),
-                unit=self._content['unittext'][int(
-                    self._content['unittextmap'][channel_number][0]) - 1].strip(),
-                offset=float(self._content['firstsampleoffset'][channel_number][0]),
-                markers=markers[channel_number]
+                unit=self._content['unittext'][unit_index].strip() if unit_index >= 0 else '',
+                offset=float(self._content['firstsampleoffset'][channel_number][block]),
+                markers=self.marker_table.select(channel=channel_number, block=block),
+                source=self.data_source if self._lazy else None,
+                data_range=(data_start, data_end),
+                block=block,
             ))
         
         return result
     
+    @staged('extract_markers')
     def _extract_markers(self):
-        # -1 for all indices as adicht uses 1 based arrays
-        return [Marker(
-            channel=int(spec[0]) - 1,
-            block=int(spec[1]) - 1,
-            position=int(spec[2]) - 1,
-            marker_type=int(spec[3]),
-            text=self._content['comtext'][int(spec[4]) - 1].strip(),
-            tickrate=self.metadata['tickrate']
-        ) for spec in self._content['com']]
-    
\ No newline at end of file
+        return MarkerTable.from_content(self._content['com'], self._content['comtext'],
+                                        self._content['tickrate'])
@@ -0,0 +1,39 @@
+# coding: utf-8
+
+import numpy
+
+
+def get_decimation_indices(values, buckets):
+    """Return the indices of the samples to plot if only buckets x positions can be shown.
+
+    The values are split into buckets of equal size, the minimum and the
+    maximum of every bucket are kept (in their original order), so peaks
+    survive the decimation. First and last sample are always kept.
+    """
+    count = len(values)
+
+    if buckets < 1 or count <= 2 * buckets:
+        return numpy.arange(count)
+
+    bucket_size = -(-count // buckets)
+    full_buckets = count // bucket_size
+    offsets = numpy.arange(full_buckets) * bucket_size
+
+    values = numpy.asarray(values)
+    matrix = values[:full_buckets * bucket_size].reshape(full_buckets, bucket_size)
+    minima = offsets + numpy.argmin(matrix, axis=1)
+    maxima = offsets + numpy.argmax(matrix, axis=1)
+
+    indices = [minima, maxima, [0, count - 1]]
+
+    if full_buckets * bucket_size < count:
+        rest = values[full_buckets * bucket_size:]
+        start = full_buckets * bucket_size
+        indices.append([start + numpy.argmin(rest), start + numpy.argmax(rest)])
+
+    return numpy.unique(numpy.concatenate(indices))
+
+
+def get_pixel_width(figure_size, dpi):
+    """Return the number of pixel columns of a figure of the given size (in inches)."""
+    return int(figure_size[0] * dpi)
@@ -1,18 +1,106 @@
 # coding: utf-8
 
+import random
+from functools import partial
+
 from adicht.colors import COLORS, get_random_color
-from adicht.evaluation import get_evaluated_stimulations, STIMULATION_END_MARKER, INTEGRAL_END_MARKER
+from adicht.decimation import get_decimation_indices, get_pixel_width
+from adicht.document import PNG_MIME_TYPE, SVG_MIME_TYPE, get_current_document
+from adicht.markers import MarkerCategory
+from adicht.instrumentation import staged
+from adicht.parallel import get_evaluated_channels
+from adicht.plotting import PNG, SVG, Plot, PlotRenderer
+
+import numpy
+
+# matplotlib and IPython are imported on first use, reports without plots
+# (and the in-process rendering) should not pay for them. The plots are
+# rendered off-screen by adicht.plotting, in parallel with ADICHT_PLOT_WORKERS.
+
+
+FIGURE_SIZE = (15, 5)
+
+# plot every sample instead of the min/max per pixel column
+FULL_RESOLUTION = False
+
+# image format of the plots (PNG or SVG)
+FIGURE_FORMAT = PNG
 
-from IPython.display import Markdown, HTML, display
-from matplotlib import pyplot
+# the marker colors are random, but the same in every run, so unchanged plots
+# give the same images (stored only once as external report assets)
+COLOR_SEED = 0
+
+
+def get_plot_indices(values, full_resolution=None):
+    """Return the indices of the samples needed to plot the values in a figure."""
+    import matplotlib
+
+    if full_resolution is None:
+        full_resolution = FULL_RESOLUTION
+
+    if full_resolution:
+        return numpy.arange(len(values))
+
+    return get_decimation_indices(
+        values, get_pixel_width(FIGURE_SIZE, matplotlib.rcParams['figure.dpi']))
+
+
+def get_channels(data_file):
+    """Return the channels of all blocks (skipping the ones without data)."""
+    return [
+        channel
+        for block in data_file.blocks
+        for channel in block.channels
+        if channel.sample_count
+    ]
+
+
+def get_channel_title(data_file, channel):
+    if len(data_file.blocks) > 1:
+        return '%s (block %d)' % (channel.title, channel.block + 1)
+    return channel.title
 
 
 def display_markdown(text):
-    display(Markdown(text))
+    document = get_current_document()
+    if document is not None:
+        document.add_markdown(text)
+    else:
+        from IPython.display import Markdown, display
+        display(Markdown(text))
 
 
 def display_html(text):
-    display(HTML(text))
+    document = get_current_document()
+    if document is not None:
+        document.add_html(text)
+    else:
+        from IPython.display import HTML, display
+        display(HTML(text))
+
+
+def display_image(data, format=PNG):
+    """Display the image data of the given format (PNG or SVG)."""
+    document = get_current_document()
+    if document is not None:
+        document.add_image(data, SVG_MIME_TYPE if format == SVG else PNG_MIME_TYPE)
+    else:
+        from IPython.display import Image, SVG as SVGImage, display
+        display(SVGImage(data=data) if format == SVG else Image(data=data))
+
+
+def display_outputs(outputs, workers=None):
+    """Display the given outputs in order.
+    
+    Plot objects are rendered to images (in worker processes if workers or
+    ADICHT_PLOT_WORKERS is greater than 1), all other outputs are called.
+    """
+    with PlotRenderer(workers, FIGURE_FORMAT) as renderer:
+        for entry in renderer.render_all(outputs):
+            if isinstance(entry, bytes):
+                display_image(entry, renderer.format)
+            else:
+                entry()
 
 
 def display_table(table_data):
@@ -22,18 +110,23 @@ def display_table(table_data):
     lines = [format_row(row) for row in table_data]
     lines.insert(1, format_row(['---'] * len(table_data[0])))
     
-    display(Markdown('\n'.join(lines)))
+    display_markdown('\n'.join(lines))
 
     
 def display_metadata(data_file):
-    display(Markdown('''
-| Tick rate | Block times |
-| --- | --- |
-| %(tickrate)f | %(blocktimes)f |
-    ''' % data_file.metadata))
+    display_markdown('''
+| Tick rate | Block times | Blocks |
+| --- | --- | --- |
+| %(tickrate)f | %(blocktimes)f | %(blocks)d |
+    ''' % data_file.metadata)
 
     
-def display_channels(data_file):
+@staged('plot_channels')
+def display_channels(data_file, full_resolution=None):
+    display_outputs(_get_channel_outputs(data_file, full_resolution))
+
+
+def _get_channel_outputs(data_file, full_resolution=None):
     table_cols = [
         ('Range min', 'rangemin'),
         ('Range max', 'rangemax'),
@@ -41,25 +134,24 @@ def display_channels(data_file):
         ('Sample rate (s)', 'samplerate'),
     ]
     
-    for channel in data_file.channels:
-        display(Markdown('#### %s' % channel.title))
+    for channel in get_channels(data_file):
+        yield partial(display_markdown, '#### %s' % get_channel_title(data_file, channel))
         
         table = [[col[0] for col in table_cols]]             + [[getattr(channel, col[1]) for col in table_cols]]
-        display_table(table)
+        yield partial(display_table, table)
         
-        plot = pyplot.figure(figsize=(15, 5))
+        plot = Plot(FIGURE_SIZE, xlabel='s', ylabel=channel.unit)
         
-        pyplot.plot(channel.timed_data[1], channel.timed_data[0], label=channel.title, color='#66cc00')
-        pyplot.xlabel('s')
-        pyplot.ylabel(channel.unit)
+        indices = get_plot_indices(channel.data, full_resolution)
+        plot.add_line(channel.get_time(indices), channel.data[indices], label=channel.title, color='#66cc00')
         
         for index, entry in enumerate(channel.markers):
-            pyplot.axvline(x=entry.timed_position, label=entry.text,
-                           color=COLORS[index])
+            plot.add_vertical_line(entry.timed_position, label=entry.text,
+                                   color=COLORS[index % len(COLORS)])
         
-        legend = pyplot.legend(loc='upper right', shadow=True,
-                               bbox_to_anchor=(1.3, 1.1))
-        pyplot.show()
+        plot.set_legend(loc='upper right', shadow=True,
+                        bbox_to_anchor=(1.3, 1.1))
+        yield plot
 
 def display_markers(data_file):
     table_cols = [
@@ -74,40 +166,43 @@ def display_markers(data_file):
     display_table(table)
 
 
-def display_stimulations(data_file):
-    for channel_number, channel in enumerate(data_file.channels): 
-        display(Markdown('#### %s' % channel.title))
+@staged('plot_stimulations')
+def display_stimulations(data_file, full_resolution=None):
+    display_outputs(_get_stimulation_outputs(data_file, full_resolution))
+
+
+def _get_stimulation_outputs(data_file, full_resolution=None):
+    channels = get_channels(data_file)
+
+    for channel, stimulations in zip(channels, get_evaluated_channels(data_file, channels)):
+        yield partial(display_markdown, '#### %s' % get_channel_title(data_file, channel))
         
-        for stimulation in get_evaluated_stimulations(channel):
-            display(Markdown('##### %r - %r' % (stimulation['from_marker'].text, stimulation['to_marker'].text)))
+        for stimulation in stimulations:
+            yield partial(display_markdown, '##### %r - %r' % (stimulation['from_marker'].text, stimulation['to_marker'].text))
             
-            plot = pyplot.figure(figsize=(15, 5))
-            pyplot.plot(stimulation['data'][1], stimulation['data'][0])
+            plot = Plot(FIGURE_SIZE, xlabel='s', ylabel=channel.unit)
             
-            pyplot.xlabel('s')
-            pyplot.ylabel(channel.unit)
+            plot_indices = get_plot_indices(stimulation.values, full_resolution)
+            plot.add_line(stimulation.times[plot_indices], stimulation.values[plot_indices])
             
-            pyplot.axvline(x=stimulation['max_value'][1], label='[calc] Maximum', color='red')
+            plot.add_vertical_line(stimulation['max_value'][1], label='[calc] Maximum', color='red')
 
             used_colors = []
+            color_generator = random.Random(COLOR_SEED)
             for index, entry in enumerate(stimulation['markers']):
-                if entry.text.lower().strip() not in (
-                    stimulation['from_marker'].text.lower().strip(),
-                    stimulation['to_marker'].text.lower().strip(),
-                    STIMULATION_END_MARKER,
-                    INTEGRAL_END_MARKER,
-                ):
+                # the delimiters, stimulation end and integral end
+                if entry.category == MarkerCategory.OTHER:
                     continue
 
-                color = get_random_color(used_colors)
-                pyplot.axvline(x=entry.timed_position, label=entry.text,
-                               color=color)
+                color = get_random_color(used_colors, color_generator)
+                plot.add_vertical_line(entry.timed_position, label=entry.text,
+                                       color=color)
                 used_colors.append(color)
             
-            legend = pyplot.legend(loc='upper right', shadow=True,
-                           bbox_to_anchor=(1.3, 1.1))
+            plot.set_legend(loc='upper right', shadow=True,
+                            bbox_to_anchor=(1.3, 1.1))
                  
-            pyplot.show()
+            yield plot
             
             table = [
                 [
@@ -128,4 +223,4 @@ def display_stimulations(data_file):
                 ]
             ]
             
-            display_table(table)
\ No newline at end of file
+            yield partial(display_table, table)
\ No newline at end of file
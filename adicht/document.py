@@ -0,0 +1,137 @@
+# coding: utf-8
+
+import base64
+import contextvars
+from html import escape
+from contextlib import contextmanager
+
+
+MARKDOWN_MIME_TYPE = 'text/markdown'
+HTML_MIME_TYPE = 'text/html'
+PNG_MIME_TYPE = 'image/png'
+SVG_MIME_TYPE = 'image/svg+xml'
+IMAGE_MIME_TYPES = [PNG_MIME_TYPE, SVG_MIME_TYPE]
+
+HTML_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; margin: 1em 0; }
+th, td { border: 1px solid #ccc; padding: 0.2em 0.6em; text-align: right; }
+img { max-width: 100%%; }
+</style>
+</head>
+<body>
+%(body)s
+</body>
+</html>
+'''
+
+# per thread (and context), reports rendered concurrently do not mix up their outputs
+_current_document = contextvars.ContextVar('adicht_document', default=None)
+
+
+def get_current_document():
+    """Return the document the display functions currently render to (or None)."""
+    return _current_document.get()
+
+
+@contextmanager
+def render_to(document):
+    """Let the display functions render to the given document instead of IPython."""
+    token = _current_document.set(document)
+
+    try:
+        yield document
+    finally:
+        _current_document.reset(token)
+
+
+def markdown_to_html(text):
+    import mistune
+
+    if hasattr(mistune, 'create_markdown'):
+        return mistune.create_markdown(plugins=['table'])(text)
+    return mistune.markdown(text)
+
+
+class Document(object):
+    """In-process document model for the output of a report.
+
+    The display functions append their output to the current document (see
+    render_to), which can be written to HTML or to a notebook with
+    populated outputs without executing a kernel.
+    """
+
+    def __init__(self, title=''):
+        self._title = title
+        self._outputs = []
+
+    @property
+    def title(self):
+        return self._title
+
+    @property
+    def outputs(self):
+        """Read only access to the (mime type, content) tuples of the document."""
+        return self._outputs
+
+    def add_markdown(self, text):
+        self._outputs.append((MARKDOWN_MIME_TYPE, text))
+
+    def add_html(self, text):
+        self._outputs.append((HTML_MIME_TYPE, text))
+
+    def add_image(self, data, mime_type=PNG_MIME_TYPE):
+        """Add the image data (bytes) of the given mime type (see IMAGE_MIME_TYPES)."""
+        self._outputs.append((mime_type, data))
+
+    def to_html(self, image_tag=None):
+        """Return the document as HTML page.
+
+        The images are inlined, unless image_tag is given: it is called with
+        the image data and mime type and returns the HTML of the image.
+        """
+        body = []
+
+        for mime_type, content in self._outputs:
+            if mime_type == MARKDOWN_MIME_TYPE:
+                body.append(markdown_to_html(content))
+            elif mime_type in IMAGE_MIME_TYPES and image_tag is not None:
+                body.append(image_tag(content, mime_type))
+            elif mime_type in IMAGE_MIME_TYPES:
+                body.append('<img src="data:%s;base64,%s">'
+                            % (mime_type, base64.b64encode(content).decode('ascii')))
+            else:
+                body.append(content)
+
+        return HTML_TEMPLATE % {'title': escape(self._title), 'body': '\n'.join(body)}
+
+    def to_notebook(self, notebook=None):
+        """Return the given notebook (or a new one) with the document as output of its last code cell."""
+        import nbformat
+
+        if notebook is None:
+            notebook = nbformat.v4.new_notebook()
+            notebook.cells.append(nbformat.v4.new_code_cell())
+
+        cell = [entry for entry in notebook.cells if entry.cell_type == 'code'][-1]
+        cell.execution_count = 1
+        cell.outputs = [
+            nbformat.v4.new_output('display_data', data={mime_type: _to_notebook_data(mime_type, content)})
+            for mime_type, content in self._outputs
+        ]
+
+        return notebook
+
+
+def _to_notebook_data(mime_type, content):
+    # notebooks store binary images base64 encoded, SVG as text
+    if mime_type == PNG_MIME_TYPE:
+        return base64.b64encode(content).decode('ascii')
+    if mime_type == SVG_MIME_TYPE:
+        return content.decode('utf-8')
+    return content
@@ -1,124 +1,367 @@
 # coding: utf-8
 
-import re
-import copy
 from enum import Enum
 
 import numpy
-from scipy.interpolate import interp1d
-from scipy.integrate import simps, cumtrapz
 
-
-STIMULATION_END_MARKER = 'stim ende'
-INTEGRAL_END_MARKER = 'int ende'
-
-MARKER_PATTERNS = [
-        re.compile(entry)
-        for entry in ['el. stim.*', '(.*?)ser(.*)', '(.*?)ser(.*)']
-        ]
+from adicht.data import Marker
+from adicht.instrumentation import stage, staged
+from adicht.markers import MarkerCategory, STIMULATION_END_MARKER, INTEGRAL_END_MARKER, normalize_text
 
 class IntegralReference:
     TO_START = 0
     TO_BASELINE = 1
 
 
-def extract_stimulations(channel):
-    delimiter_markers = [
-            entry 
-            for entry in channel.markers 
-            if any([pattern.match(entry.text.lower())
-            for pattern in MARKER_PATTERNS])
-    ]
+class IntegrationMethod:
+    TRAPEZOID = 0
+    SIMPSON = 1
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class ChannelIntegrator(object):
+    """Integrates arbitrary sample ranges of (equidistantly sampled) channel data.
     
-    result = []
+    The cumulative integral (trapezoidal rule) of the data is calculated
+    once, every integral is the difference of two of its entries afterwards.
+    The cumulative integral is calculated in float64, float32 recordings
+    would lose the precision of the differences over long channels otherwise.
+    The SIMPSON method integrates every range with scipy's simpson instead,
+    for parity with results of earlier versions.
+    """
     
-    for i in range(len(delimiter_markers) - 1):
-        from_marker = delimiter_markers[i]
-        to_marker = delimiter_markers[i+1]
-
-        contained_markers = copy.deepcopy(channel.markers[channel.markers.index(from_marker):channel.markers.index(to_marker)+1])
-        for entry in contained_markers:
-            entry.apply_time_offest(from_marker.timed_position)
+    def __init__(self, data, samplerate, method=IntegrationMethod.TRAPEZOID):
+        self._data = data
+        self._samplerate = samplerate
+        self._method = method
+        self._cumulative = None
         
-        from_timed_pos = numpy.where(channel.timed_data[1] == from_marker.timed_position)[0][0]
-        to_timed_pos = numpy.where(channel.timed_data[1] == to_marker.timed_position)[0][0] + 1
+        if method == IntegrationMethod.TRAPEZOID:
+            # calculated in place, a recording is held in float64 only once
+            values = numpy.asarray(data)
+            self._cumulative = numpy.empty(len(values))
+            self._cumulative[:1] = 0.0
+            steps = self._cumulative[1:]
+            numpy.add(values[1:], values[:-1], out=steps, dtype=numpy.float64)
+            steps /= 2 * samplerate
+            numpy.cumsum(steps, out=steps)
+    
+    def integrate(self, start, stop, reference=IntegralReference.TO_START):
+        """Integrate the samples [start, stop) minus the integral of the reference.
+        
+        TO_START subtracts the value of the first sample over the whole range,
+        TO_BASELINE the straight line between the first and the last sample.
+        """
+        last = stop - 1
+        if last <= start:
+            return numpy.nan
+        
+        if self._method == IntegrationMethod.SIMPSON:
+            from scipy.integrate import simpson
+            full_integral = simpson(self._data[start:stop], x=numpy.arange(start, stop) / self._samplerate)
+        else:
+            full_integral = self._cumulative[last] - self._cumulative[start]
+        
+        return full_integral - get_reference_integral(
+            float(self._data[start]), float(self._data[last]), (last - start) / self._samplerate, reference)
+
+
+def get_delimiter_rows(channel):
+    """Return the rows of the markers separating the stimulations within the channel markers."""
+    return numpy.flatnonzero(channel.markers.get_categories() == MarkerCategory.STIMULATION_START.value)
+
+
+def get_delimiter_markers(channel):
+    """Return the markers separating the stimulations of a channel."""
+    return channel.markers[get_delimiter_rows(channel)]
+
+
+class Stimulation(object):
+    """The samples of a channel between two delimiter markers.
+    
+    Only the channel and the sample range are stored, the data is a view to
+    the channel data and times and markers (relative to the start of the
+    stimulation) are created on access. The keys of the former stimulation
+    dicts ('data', 'markers', 'max_value', ...) are still supported as items.
+    """
+    
+    __slots__ = ('_channel', '_start', '_stop', '_first_row', '_last_row', '_data',
+                 'duration', 'max_value', 'integral_end_time',
+                 'stimulation_answer_integrated', 'full_answer_integrated')
+    
+    ITEMS = ('start_index', 'from_marker', 'to_marker', 'markers', 'samplerate',
+             'duration', 'max_value', 'integral_end_time',
+             'stimulation_answer_integrated', 'full_answer_integrated')
+    
+    def __init__(self, channel, start, stop, first_row, last_row, data=None):
+        """Create the stimulation of the samples [start, stop) of channel.
         
-        data = channel.timed_data[..., from_timed_pos:(to_timed_pos)]
-        #data[...,:] -= from_timed_pos
-        data = numpy.stack((data[0], data[1] - data[1][0]))
+        first_row and last_row are the rows of the delimiter markers within
+        the channel markers. data are the samples of the range if they were
+        already read (they are read from the channel on access otherwise).
+        """
+        self._channel = channel
+        self._start = start
+        self._stop = stop
+        self._first_row = first_row
+        self._last_row = last_row
+        self._data = data
         
-        result.append({
-                'from_marker': contained_markers[0],
-                'to_marker': contained_markers[-1],
-                'markers': contained_markers,
-                'data': data
-                })
+        self.duration = None
+        self.max_value = None
+        self.integral_end_time = None
+        self.stimulation_answer_integrated = None
+        self.full_answer_integrated = None
+    
+    def __len__(self):
+        return self._stop - self._start
+    
+    def __getitem__(self, key):
+        if key == 'data':
+            return self.get_timed_data()
+        if key not in self.ITEMS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.ITEMS[5:]:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __repr__(self):
+        return '<Stimulation %r - %r at %fs>' % (
+            self.from_marker.text, self.to_marker.text, self.start_time)
+    
+    @property
+    def channel(self):
+        return self._channel
+    
+    @property
+    def start_index(self):
+        """Read only access to the index of the first sample within the channel."""
+        return self._start
+    
+    @property
+    def stop_index(self):
+        """Read only access to the index after the last sample within the channel."""
+        return self._stop
+    
+    @property
+    def marker_rows(self):
+        """Read only access to the rows of the delimiter markers within the channel markers."""
+        return self._first_row, self._last_row
+    
+    @property
+    def samplerate(self):
+        return self._channel.samplerate
+    
+    @property
+    def start_time(self):
+        """Read only access to the (absolute) time of the delimiter marker the stimulation starts at."""
+        return float(self._channel.markers.times[self._first_row])
+    
+    @property
+    def values(self):
+        """Read only access to the samples of the stimulation."""
+        if self._data is None:
+            self._data = self._channel.read(self._start, self._stop)
+        return self._data
+    
+    @property
+    def times(self):
+        """Read only access to the sample times (relative to the first sample)."""
+        return numpy.arange(len(self)) / self.samplerate
+    
+    @property
+    def from_marker(self):
+        return self._get_marker(self._first_row)
+    
+    @property
+    def to_marker(self):
+        return self._get_marker(self._last_row)
+    
+    @property
+    def markers(self):
+        """Read only access to the markers from the start to the end delimiter (with relative times)."""
+        return [self._get_marker(row) for row in range(self._first_row, self._last_row + 1)]
     
-    return result
+    @property
+    def marker_table(self):
+        """Read only access to the markers from the start to the end delimiter (as MarkerTable)."""
+        return self._channel.markers[self._first_row:self._last_row + 1]
+    
+    @property
+    def marker_times(self):
+        """Read only access to the marker times relative to the start of the stimulation."""
+        return self.marker_table.times - self.start_time
+    
+    def get_timed_data(self):
+        """Return a 2D array of the samples and their (relative) times."""
+        return numpy.stack((self.values, self.times))
+    
+    def _get_marker(self, row):
+        return Marker(self._channel.markers, row, self.start_time)
+
+
+def create_stimulation(channel, first_row, last_row, data=None):
+    """Create the stimulation between the delimiter markers at the given rows of the channel markers."""
+    start = channel.get_marker_index(Marker(channel.markers, first_row))
+    stop = channel.get_marker_index(Marker(channel.markers, last_row)) + 1
+    
+    return Stimulation(channel, start, stop, first_row, last_row, data)
+
+
+@staged('extract_stimulations')
+def extract_stimulations(channel):
+    delimiter_rows = get_delimiter_rows(channel)
+    
+    return [
+        create_stimulation(channel, int(delimiter_rows[i]), int(delimiter_rows[i+1]))
+        for i in range(len(delimiter_rows) - 1)
+    ]
 
 
 def get_integral_end_marker(stimulation):
     return list(
-        filter(lambda marker: marker.text.lower().strip() == INTEGRAL_END_MARKER, stimulation['markers'])
+        filter(lambda marker: marker.category == MarkerCategory.INTEGRAL_END, stimulation['markers'])
     ) or None
 
 
+def get_reference_integral(start_value, end_value, width, reference=IntegralReference.TO_START):
+    """Return the integral of the reference line between two samples."""
+    if reference == IntegralReference.TO_BASELINE:
+        return (start_value + end_value) / 2 * width
+    return start_value * width
+
+
 def get_stimulation_integral(stimulation, from_marker_text, to_marker_text, reference=IntegralReference.TO_START):
-    from_marker = list(
-        filter(lambda marker: marker.text.lower().strip() == from_marker_text.lower().strip(), stimulation['markers'])
-    )
-    to_marker = list(
-        filter(lambda marker: marker.text.lower().strip() == to_marker_text.lower().strip(), stimulation['markers'])
-    )
-
-    if not to_marker or not from_marker:
-        return None, numpy.nan
+    from scipy.integrate import simpson
 
-    from_pos = numpy.where(stimulation['data'][1] == from_marker[0].timed_position)[0][0]
-    to_pos = numpy.where(stimulation['data'][1] == to_marker[0].timed_position)[0][0]
+    from_marker_text = normalize_text(from_marker_text)
+    to_marker_text = normalize_text(to_marker_text)
 
-    integration_data = stimulation['data'][..., from_pos:to_pos]
+    texts = stimulation.marker_table.get_normalized_texts()
+    from_rows = numpy.flatnonzero(texts == from_marker_text)
+    to_rows = numpy.flatnonzero(texts == to_marker_text)
 
-    full_integral = simps(integration_data[0], integration_data[1])
+    if not len(to_rows) or not len(from_rows):
+        return None, numpy.nan
 
-    start = integration_data[..., from_pos]
-    end = integration_data[..., to_pos - 1]
+    # the marker times are relative to the first sample of the stimulation
+    marker_times = stimulation.marker_times
+    from_pos = int(round(marker_times[from_rows[0]] * stimulation.samplerate))
+    to_pos = int(round(marker_times[to_rows[0]] * stimulation.samplerate))
 
-    if reference == IntegralReference.TO_BASELINE:
-        x = integration_data[1]
-        slope = (end[0] - start[0]) / (end[1] - start[1])
-        y = slope * (x - start[1]) + start[0]
+    integration_data = numpy.stack((stimulation.values[from_pos:to_pos], stimulation.times[from_pos:to_pos]))
 
-        substraction = simps(y, x)
-    else:
-        substraction = simps(numpy.full((1, len(integration_data[0])), start[0])[0], integration_data[1])
+    full_integral = simpson(integration_data[0], x=integration_data[1])
 
-    return integration_data, (full_integral - substraction)
+    start = integration_data[..., 0]
+    end = integration_data[..., -1]
 
+    return integration_data, (full_integral - get_reference_integral(start[0], end[0], end[1] - start[1], reference))
 
-def get_evaluated_stimulations(channel):
-    stimulations = extract_stimulations(channel)
+
+def evaluate_stimulation(stimulation, integrator, offset=None):
+    """Add duration, maximum and integrals to the given stimulation.
     
-    for entry in stimulations:
-        max_val_index = numpy.argmax(entry['data'][0])
-        entry['integral_end_time'] = numpy.nan
-        entry['duration'] = entry['to_marker'].timed_position - entry['from_marker'].timed_position
+    offset is the index of the first sample of the stimulation within the
+    data of the integrator (by default its start index within the channel).
+    """
+    start = stimulation.start_index if offset is None else offset
+    
+    # the first marker per category, relative to the start of the stimulation
+    marker_table = stimulation.marker_table
+    categories = marker_table.get_categories()
+    marker_times = stimulation.marker_times
+    marker_indices = {}
+    for row in reversed(range(len(categories))):
+        marker_indices[MarkerCategory(int(categories[row]))] = (
+            row, int(round(marker_times[row] * stimulation.samplerate)))
+    
+    values = stimulation.values
+    max_val_index = numpy.argmax(values)
+    stimulation.integral_end_time = numpy.nan
+    stimulation.duration = marker_times[-1] - marker_times[0]
+    stimulation.full_answer_integrated = numpy.nan
+    stimulation.stimulation_answer_integrated = numpy.nan
 
-        full_answer_data, full_answer_integrated = get_stimulation_integral(entry,
-                                                                          entry['from_marker'].text,
-                                                                          INTEGRAL_END_MARKER, reference=IntegralReference.TO_BASELINE)
-        stimulation_answer_data, stimulation_answer_integrated = get_stimulation_integral(entry,
-                                                                                        entry['from_marker'].text,
-                                                                                        STIMULATION_END_MARKER)
+    if MarkerCategory.STIMULATION_END in marker_indices:
+        _, stimulation_end = marker_indices[MarkerCategory.STIMULATION_END]
+        stimulation.stimulation_answer_integrated = integrator.integrate(
+            start, start + stimulation_end)
 
-        entry['full_answer_integrated'] = full_answer_integrated
-        entry['stimulation_answer_integrated'] = stimulation_answer_integrated
+    if MarkerCategory.INTEGRAL_END in marker_indices:
+        integral_end_row, integral_end = marker_indices[MarkerCategory.INTEGRAL_END]
+        stimulation.full_answer_integrated = integrator.integrate(
+            start, start + integral_end, reference=IntegralReference.TO_BASELINE)
+        
+        if integral_end > 0:
+            max_val_index = numpy.argmax(values[:integral_end])
+        stimulation.integral_end_time = marker_times[integral_end_row]
+
+    stimulation.max_value = numpy.array((values[max_val_index], max_val_index / stimulation.samplerate))
+    
+    return stimulation
 
-        if full_answer_data is not None:
-            max_val_index = numpy.argmax(full_answer_data[0])
-            entry['integral_end_time'] = get_integral_end_marker(entry)[0].timed_position
 
-        entry['max_value'] = entry['data'][..., max_val_index]
+def get_evaluated_stimulations(channel, method=IntegrationMethod.TRAPEZOID):
+    stimulations = extract_stimulations(channel)
+    
+    with stage('evaluate_stimulations'):
+        integrator = ChannelIntegrator(channel.data, channel.samplerate, method)
+        
+        for entry in stimulations:
+            evaluate_stimulation(entry, integrator)
+    
+    return stimulations
+
 
+def iter_evaluated_stimulations(channel, chunk_size=DEFAULT_CHUNK_SIZE, method=IntegrationMethod.TRAPEZOID):
+    """Evaluate the stimulations of a channel while reading its data in chunks.
+    
+    The stimulations are processed in time order and yielded as soon as
+    their data is complete, only the data of the current stimulation (plus
+    at most one chunk) is kept in memory. Use this with lazily loaded files
+    to evaluate recordings which do not fit into memory.
+    """
+    delimiter_rows = get_delimiter_rows(channel)
+    delimiter_rows = delimiter_rows[numpy.argsort(channel.markers.times[delimiter_rows], kind='stable')]
+    
+    buffer = numpy.empty(0)
+    buffer_start = 0
     
-    return stimulations
\ No newline at end of file
+    for i in range(len(delimiter_rows) - 1):
+        first_row = int(delimiter_rows[i])
+        last_row = int(delimiter_rows[i+1])
+        
+        start = channel.get_marker_index(Marker(channel.markers, first_row))
+        stop = channel.get_marker_index(Marker(channel.markers, last_row)) + 1
+        
+        # drop the data before the stimulation
+        if buffer_start <= start < buffer_start + len(buffer):
+            buffer = buffer[start - buffer_start:]
+        else:
+            buffer = numpy.empty(0)
+        buffer_start = start
+        
+        chunks = [buffer]
+        read_position = buffer_start + len(buffer)
+        while read_position < stop:
+            chunk = channel.read(read_position, read_position + chunk_size)
+            if not len(chunk):
+                break
+            chunks.append(chunk)
+            read_position += len(chunk)
+        
+        if len(chunks) > 1:
+            buffer = numpy.concatenate(chunks)
+        
+        window = buffer[:stop - start]
+        with stage('evaluate_stimulations'):
+            stimulation = Stimulation(channel, start, stop, first_row, last_row, window)
+            evaluate_stimulation(stimulation, ChannelIntegrator(window, channel.samplerate, method), 0)
+        
+        yield stimulation
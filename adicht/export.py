@@ -0,0 +1,311 @@
+# coding: utf-8
+"""Export of the evaluation results to columnar files, combined into a dataset.
+
+Every data file is exported to three tables (stimulations, channels,
+markers). A dataset directory contains a sub directory per table with one
+part file per data file:
+
+    dataset/stimulations/part-<recording>-<path hash>.parquet
+    dataset/channels/...
+    dataset/markers/...
+
+Exporting further files only adds parts, exporting a file again replaces
+its own parts. Parquet is written if pyarrow is installed, otherwise CSV.
+load_table and summarize query the dataset without re-evaluating anything.
+"""
+
+import os
+import csv
+import math
+import hashlib
+
+import numpy
+
+
+PARQUET = 'parquet'
+FEATHER = 'feather'
+CSV = 'csv'
+FORMATS = [PARQUET, FEATHER, CSV]
+
+STIMULATIONS = 'stimulations'
+CHANNELS = 'channels'
+MARKERS = 'markers'
+TABLES = [STIMULATIONS, CHANNELS, MARKERS]
+
+
+def get_default_format():
+    """Return PARQUET if pyarrow is available, CSV otherwise."""
+    try:
+        import pyarrow
+    except ImportError:
+        return CSV
+    return PARQUET
+
+
+def create_tables(data_file):
+    """Evaluate the given ADichtMatlabFile and return its tables (dicts of columns)."""
+    from adicht.features import extract_features
+    from adicht.parallel import get_evaluated_channels
+
+    source = os.path.abspath(data_file.filename)
+    stimulations = _Columns()
+    channels = _Columns()
+
+    # the channels of all blocks at once (in parallel, if configured)
+    evaluated_channels = iter(get_evaluated_channels(data_file))
+
+    for block in data_file.blocks:
+        for channel_number, channel in enumerate(block.channels):
+            evaluated = next(evaluated_channels)
+            channels.append(
+                source=source,
+                block=block.index,
+                channel=channel_number,
+                title=channel.title,
+                unit=channel.unit,
+                samplerate=channel.samplerate,
+                rangemin=channel.rangemin,
+                rangemax=channel.rangemax,
+                sample_count=channel.sample_count,
+                time_offset=channel.time_offset,
+            )
+
+            if not channel.sample_count:
+                continue
+
+            # features are computed for the same windows as the evaluation
+            features = extract_features(
+                channel,
+                numpy.array([entry['start_index'] for entry in evaluated], dtype=int),
+                numpy.array([entry.stop_index for entry in evaluated], dtype=int))
+
+            for index, entry in enumerate(evaluated):
+                row = dict(
+                    source=source,
+                    block=block.index,
+                    channel=channel_number,
+                    stimulation=index,
+                    start_time=channel.get_time(entry['start_index']),
+                    from_marker=entry['from_marker'].text,
+                    to_marker=entry['to_marker'].text,
+                    duration=entry['duration'],
+                    max_value=entry['max_value'][0],
+                    time_of_max=entry['max_value'][1],
+                    integral_end_time=entry['integral_end_time'],
+                    stimulation_answer_integrated=entry['stimulation_answer_integrated'],
+                    full_answer_integrated=entry['full_answer_integrated'],
+                )
+                row.update((name, values[index]) for name, values in features.items()
+                           if name not in ('start_index', 'stop_index', 'start_time'))
+                stimulations.append(**row)
+
+    records = data_file.marker_table.records
+    markers = {
+        'source': numpy.full(len(records), source, dtype=object),
+        'index': records['index'],
+        'channel': records['channel'],
+        'block': records['block'],
+        'position': records['position'],
+        'time': records['time'],
+        'type': records['type'],
+        'text': data_file.marker_table.get_texts().astype(object),
+        'category': numpy.array([
+            entry.name.lower() for entry in _get_categories(data_file.marker_table)], dtype=object),
+    }
+
+    return {
+        STIMULATIONS: stimulations.to_arrays(),
+        CHANNELS: channels.to_arrays(),
+        MARKERS: markers,
+    }
+
+
+def export_file(data_file_path, dataset_dir, format=None):
+    """Evaluate the given file and write its tables to the dataset.
+
+    Returns the paths of the written part files.
+    """
+    from adicht.data import ADichtMatlabFile
+
+    format = format or get_default_format()
+    with ADichtMatlabFile(data_file_path) as data_file:
+        tables = create_tables(data_file)
+    part_name = get_part_name(data_file_path)
+
+    result = []
+    for name, columns in tables.items():
+        table_dir = os.path.join(dataset_dir, name)
+        os.makedirs(table_dir, exist_ok=True)
+
+        # parts of a previous export (possibly in another format) are replaced
+        for entry in FORMATS:
+            path = os.path.join(table_dir, '%s.%s' % (part_name, entry))
+            if entry != format and os.path.exists(path):
+                os.remove(path)
+
+        path = os.path.join(table_dir, '%s.%s' % (part_name, format))
+        write_table(columns, path, format)
+        result.append(path)
+
+    return result
+
+
+def get_part_name(data_file_path):
+    """Return the name of the parts of a data file (unique per path)."""
+    path = os.path.abspath(data_file_path)
+    return 'part-%s-%s' % (os.path.splitext(os.path.basename(path))[0],
+                           hashlib.sha1(path.encode('utf-8')).hexdigest()[:8])
+
+
+def write_table(columns, path, format=None):
+    """Write a dict of columns to path (atomically)."""
+    format = format or get_default_format()
+    tmp_path = '%s.tmp' % path
+
+    if format == CSV:
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(columns))
+            writer.writerows(zip(*columns.values()))
+    else:
+        import pyarrow
+
+        table = pyarrow.table({name: _to_list(values) for name, values in columns.items()})
+        if format == PARQUET:
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(table, tmp_path)
+        elif format == FEATHER:
+            import pyarrow.feather
+            pyarrow.feather.write_feather(table, tmp_path)
+        else:
+            raise ValueError('Unknown format %r' % format)
+
+    os.replace(tmp_path, path)
+
+
+def read_table(path):
+    """Read a part file written by write_table into a dict of arrays."""
+    format = path.rpartition('.')[2]
+
+    if format == CSV:
+        with open(path, 'r', newline='') as f:
+            rows = list(csv.reader(f))
+        header, rows = rows[0], rows[1:]
+        return {
+            name: _parse_column([row[index] for row in rows])
+            for index, name in enumerate(header)
+        }
+
+    import pyarrow
+
+    if format == PARQUET:
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+    elif format == FEATHER:
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(path)
+    else:
+        raise ValueError('Unknown format %r' % format)
+
+    return {
+        name: numpy.array(table.column(name).to_pylist(),
+                          dtype=object if pyarrow.types.is_string(table.schema.field(name).type) else None)
+        for name in table.column_names
+    }
+
+
+def load_table(dataset_dir, table=STIMULATIONS, columns=None, where=None):
+    """Load a table of the dataset (all parts) into a dict of arrays.
+
+    columns restricts the result to the given columns, where is a dict of
+    column name -> value (or list of values) the rows have to match.
+    """
+    table_dir = os.path.join(dataset_dir, table)
+    parts = sorted(
+        os.path.join(table_dir, entry) for entry in os.listdir(table_dir)
+        if entry.rpartition('.')[2] in FORMATS
+    ) if os.path.isdir(table_dir) else []
+
+    loaded = [read_table(entry) for entry in parts]
+    loaded = [entry for entry in loaded if entry and len(next(iter(entry.values())))]
+    if not loaded:
+        return {}
+
+    names = columns or list(loaded[0])
+    result = {name: numpy.concatenate([entry[name] for entry in loaded]) for name in names}
+
+    if where:
+        mask = numpy.ones(len(result[names[0]]), dtype=bool)
+        for name, value in where.items():
+            values = numpy.concatenate([entry[name] for entry in loaded])
+            mask &= numpy.isin(values, value if isinstance(value, (list, tuple)) else [value])
+        result = {name: values[mask] for name, values in result.items()}
+
+    return result
+
+
+def summarize(table, column, group_by=()):
+    """Return count, mean, std, min and max of column per group (dict of columns).
+
+    nan values are ignored.
+    """
+    group_by = list(group_by)
+    values = numpy.asarray(table[column], dtype=float)
+    keys = list(zip(*[table[name] for name in group_by])) if group_by else [()] * len(values)
+
+    groups = {}
+    for key, value in zip(keys, values):
+        if not math.isnan(value):
+            groups.setdefault(key, []).append(value)
+
+    result = _Columns()
+    for key in sorted(groups):
+        group = numpy.array(groups[key])
+        row = dict(zip(group_by, key))
+        row.update(count=len(group), mean=group.mean(), std=group.std(), min=group.min(), max=group.max())
+        result.append(**row)
+
+    return result.to_arrays()
+
+
+def _get_categories(marker_table):
+    from adicht.markers import MarkerCategory
+
+    return [MarkerCategory(int(entry)) for entry in marker_table.get_categories()]
+
+
+def _to_list(values):
+    return [entry.item() if isinstance(entry, numpy.generic) else entry for entry in values]
+
+
+def _parse_column(values):
+    """Convert CSV values to numbers where possible."""
+    for dtype in (int, float):
+        try:
+            return numpy.array(values, dtype=dtype)
+        except ValueError:
+            pass
+    return numpy.array(values, dtype=object)
+
+
+class _Columns(object):
+    """Builds a dict of columns row by row."""
+
+    def __init__(self):
+        self._columns = {}
+        self._count = 0
+
+    def append(self, **row):
+        for name, value in row.items():
+            self._columns.setdefault(name, [None] * self._count).append(value)
+        self._count += 1
+
+        for values in self._columns.values():
+            if len(values) < self._count:
+                values.append(None)
+
+    def to_arrays(self):
+        return {
+            name: numpy.array(values, dtype=object if any(isinstance(entry, str) for entry in values) else None)
+            for name, values in self._columns.items()
+        }
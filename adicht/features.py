@@ -0,0 +1,232 @@
+# coding: utf-8
+"""Features of all stimulations of a channel, computed with segmented numpy reductions.
+
+The stimulation windows are gathered into one array, every feature is a
+reduction over its segments, so the cost per stimulation does not grow with
+the number of features. The result is a columnar table (a dict of arrays
+with one entry per stimulation):
+
+    table = extract_features(channel, features=['max', 'latency_to_peak'])
+    table['latency_to_peak'][3]
+
+All features refer to the baseline (the first sample of a stimulation),
+times are relative to the start of the stimulation (in seconds).
+Additional features can be registered in FEATURES.
+"""
+
+import numpy
+
+from adicht.evaluation import get_delimiter_markers
+
+
+RISE_LOW = 0.1
+RISE_HIGH = 0.9
+HALF = 0.5
+
+
+class Segments(object):
+    """The stimulation windows of a channel, gathered into one contiguous array.
+
+    Intermediate results which are needed by several features (like the
+    position of the peaks) are calculated once.
+    """
+
+    def __init__(self, data, starts, stops, samplerate):
+        self._starts = numpy.asarray(starts, dtype=int)
+        self._stops = numpy.asarray(stops, dtype=int)
+        self._samplerate = samplerate
+
+        self._lengths = numpy.maximum(self._stops - self._starts, 0)
+        self._offsets = numpy.concatenate(([0], numpy.cumsum(self._lengths)[:-1])).astype(int)
+        self._ids = numpy.repeat(numpy.arange(len(self._starts)), self._lengths)
+
+        # index of every value within its segment
+        self._positions = numpy.arange(len(self._ids)) - self._offsets[self._ids]
+        # float64, sums of (float32) recordings would lose precision otherwise
+        self._values = numpy.asarray(data)[self._positions + self._starts[self._ids]].astype(float, copy=False)
+
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def starts(self):
+        return self._starts
+
+    @property
+    def stops(self):
+        return self._stops
+
+    @property
+    def lengths(self):
+        return self._lengths
+
+    @property
+    def offsets(self):
+        """Read only access to the index of the first value of every segment within values."""
+        return self._offsets
+
+    @property
+    def samplerate(self):
+        return self._samplerate
+
+    @property
+    def values(self):
+        """Read only access to the samples of all segments (one after another)."""
+        return self._values
+
+    @property
+    def ids(self):
+        """Read only access to the segment of every value."""
+        return self._ids
+
+    @property
+    def positions(self):
+        """Read only access to the index of every value within its segment."""
+        return self._positions
+
+    def reduce(self, ufunc):
+        """Apply the reduction of the given ufunc per segment (nan for empty segments)."""
+        result = numpy.full(len(self), numpy.nan)
+        non_empty = self._lengths > 0
+        if non_empty.any():
+            result[non_empty] = ufunc.reduceat(self._values, self._offsets[non_empty])
+        return result
+
+    def first(self, mask):
+        """Return the index (within its segment) of the first True value of every segment (-1 if none)."""
+        result = numpy.full(len(self), -1)
+        positions = numpy.flatnonzero(mask)
+        ids = self._ids[positions]
+        # the ids are sorted, so the first True of a segment is where the id changes
+        first = numpy.flatnonzero(numpy.diff(ids, prepend=-1))
+        result[ids[first]] = self._positions[positions[first]]
+        return result
+
+    def broadcast(self, per_segment):
+        """Repeat a value per segment for every value of the segment."""
+        return numpy.asarray(per_segment)[self._ids]
+
+    def get(self, name, func):
+        """Return the cached intermediate result name, func calculates it on first access."""
+        if name not in self._cache:
+            self._cache[name] = func(self)
+        return self._cache[name]
+
+    def to_times(self, indices):
+        """Convert indices within the segments to times (nan for -1)."""
+        return numpy.where(indices >= 0, indices / self._samplerate, numpy.nan)
+
+
+def _baseline(segments):
+    result = numpy.full(len(segments), numpy.nan)
+    non_empty = segments.lengths > 0
+    result[non_empty] = segments.values[segments.offsets[non_empty]]
+    return result
+
+
+def _maximum(segments):
+    return segments.reduce(numpy.maximum)
+
+
+def _peak_index(segments):
+    peak = segments.get('max', _maximum)
+    return segments.first(segments.values == segments.broadcast(peak))
+
+
+def _crossing(segments, fraction):
+    """Index of the first sample reaching the given fraction of the amplitude."""
+    baseline = segments.get('baseline', _baseline)
+    threshold = baseline + fraction * (segments.get('max', _maximum) - baseline)
+    return segments.first(segments.values >= segments.broadcast(threshold))
+
+
+def _fall(segments, fraction):
+    """Index of the first sample after the peak below the given fraction of the amplitude."""
+    baseline = segments.get('baseline', _baseline)
+    threshold = baseline + fraction * (segments.get('max', _maximum) - baseline)
+    peak_index = segments.get('peak_index', _peak_index)
+
+    result = segments.first((segments.positions > segments.broadcast(peak_index))
+                            & (segments.values < segments.broadcast(threshold)))
+
+    # the answer did not fall below the threshold within the stimulation
+    return numpy.where((result < 0) & (peak_index >= 0), segments.lengths, result)
+
+
+def _rise_time(segments):
+    low = _crossing(segments, RISE_LOW)
+    high = _crossing(segments, RISE_HIGH)
+    return numpy.where((low >= 0) & (high >= 0), (high - low) / segments.samplerate, numpy.nan)
+
+
+def _half_width(segments):
+    rise = _crossing(segments, HALF)
+    fall = _fall(segments, HALF)
+    return numpy.where((rise >= 0) & (fall >= 0), (fall - rise) / segments.samplerate, numpy.nan)
+
+
+def _area_over_baseline(segments):
+    """Trapezoidal integral of the samples minus the baseline."""
+    total = segments.reduce(numpy.add)
+    baseline = segments.get('baseline', _baseline)
+
+    last = numpy.full(len(segments), numpy.nan)
+    non_empty = segments.lengths > 0
+    last[non_empty] = segments.values[(segments.offsets + segments.lengths - 1)[non_empty]]
+
+    area = (total - (baseline + last) / 2 - baseline * (segments.lengths - 1)) / segments.samplerate
+    return numpy.where(segments.lengths > 1, area, numpy.nan)
+
+
+# feature name -> function calculating it for all segments
+FEATURES = {
+    'max': lambda segments: segments.get('max', _maximum),
+    'min': lambda segments: segments.reduce(numpy.minimum),
+    'mean': lambda segments: segments.reduce(numpy.add) / numpy.where(segments.lengths, segments.lengths, numpy.nan),
+    'baseline': lambda segments: segments.get('baseline', _baseline),
+    'latency_to_peak': lambda segments: segments.to_times(segments.get('peak_index', _peak_index)),
+    'rise_time': _rise_time,
+    'half_width': _half_width,
+    'area_over_baseline': _area_over_baseline,
+}
+
+DEFAULT_FEATURES = ['max', 'min', 'mean', 'latency_to_peak', 'rise_time', 'half_width', 'area_over_baseline']
+
+
+def get_stimulation_bounds(channel):
+    """Return the start and stop sample indices of the stimulations of a channel.
+
+    The bounds are the ones of extract_stimulations (the stop includes the
+    sample of the following delimiter marker).
+    """
+    delimiter_markers = get_delimiter_markers(channel)
+    indices = numpy.array([channel.get_marker_index(marker) for marker in delimiter_markers], dtype=int)
+
+    return indices[:-1], indices[1:] + 1
+
+
+def extract_features(channel, starts=None, stops=None, features=None):
+    """Calculate the given features (by default DEFAULT_FEATURES) of the stimulations of a channel.
+
+    starts and stops are the sample indices of the stimulations, by default
+    the ones of get_stimulation_bounds. Returns a dict of arrays, containing
+    the bounds, the start time and one column per feature.
+    """
+    if starts is None or stops is None:
+        starts, stops = get_stimulation_bounds(channel)
+
+    stops = numpy.minimum(stops, channel.sample_count)
+    segments = Segments(channel.data, starts, stops, channel.samplerate)
+
+    table = {
+        'start_index': segments.starts,
+        'stop_index': segments.stops,
+        'start_time': channel.get_time(segments.starts),
+    }
+
+    for name in features or DEFAULT_FEATURES:
+        table[name] = FEATURES[name](segments)
+
+    return table
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+from collections import namedtuple
+
+
+INFO = 'INFO'
+ERROR = 'ERROR'
+
+LogRecord = namedtuple('LogRecord', ['time', 'level', 'message'])
+
+
+class LogQueue(object):
+    """Thread-safe queue of log records.
+
+    Worker threads put records (an instance can be used as log_callback
+    directly), the GUI drains them in batches. Drained records are appended to
+    the log file (if any), so the file contains the full log while the GUI only
+    shows the latest lines.
+    """
+
+    def __init__(self, log_file=None):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._log_file = None
+
+        self.set_log_file(log_file)
+
+    def __call__(self, message):
+        self.put(message)
+
+    def put(self, message, level=INFO):
+        self._queue.put(LogRecord(time.time(), level, message))
+
+    def drain(self, max_count=None):
+        """Return (at most max_count) queued records and write them to the log file."""
+        records = []
+
+        while max_count is None or len(records) < max_count:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        with self._lock:
+            if self._log_file is not None and records:
+                self._log_file.writelines(format_record(entry) + '\n' for entry in records)
+                self._log_file.flush()
+
+        return records
+
+    def set_log_file(self, path):
+        """Stream the log to the given file (appending), None stops streaming."""
+        with self._lock:
+            if self._log_file is not None:
+                self._log_file.close()
+            self._log_file = open(path, 'a') if path else None
+
+    def close(self):
+        self.drain()
+        self.set_log_file(None)
+
+
+def format_record(record):
+    return '%s %-5s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.time)),
+                           record.level, record.message)
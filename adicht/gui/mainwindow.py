@@ -1,52 +1,82 @@
 # -*- coding: utf-8 -*-
 
 import os
+from html import escape
 
-from PyQt5.QtCore import pyqtSlot, QSettings, pyqtSignal, QThread
-from PyQt5.QtWidgets import QMainWindow, QMessageBox, QFileDialog
+from PyQt5.QtCore import pyqtSlot, QSettings, QTimer
+from PyQt5.QtWidgets import QMainWindow, QMessageBox, QFileDialog, QTableWidgetItem
 from PyQt5.uic import loadUi
 
-from adicht.report import Reporter
+from adicht import instrumentation
+from adicht.gui.log import LogQueue, ERROR, format_record
+from adicht.gui.scheduler import JobScheduler, get_default_worker_count
 
 
 UI_DIR = os.path.join(os.path.dirname(__file__), 'ui')
 
-
-class ReportThread(QThread):
-    new_log_message = pyqtSignal(str)
-
-    def __init__(self, output_dir, data_files, parent=None):
-        QThread.__init__(self, parent)
-
-        self._output_dir = output_dir
-        self._data_files = data_files
-
-    def run(self):
-        reporter = Reporter(self._output_dir, self.new_log_message.emit)
-
-        for entry in self._data_files:
-            reporter.generate_report(entry)
+LOG_FILENAME = 'adicht-eval.log'
+# sub directory of the output directory the profiling traces are written to
+TRACE_DIRNAME = 'traces'
+# number of log lines kept in the log view (the log file contains everything)
+MAX_LOG_LINES = 5000
+LOG_INTERVAL = 200
+LOG_BATCH_SIZE = 1000
 
 
 class MainWindow(QMainWindow):
-    new_log_message = pyqtSignal(str)
-
     def __init__(self, parent=None):
         QMainWindow.__init__(self, parent)
 
         loadUi(os.path.join(UI_DIR, 'mainwindow.ui'), self)
 
-        self._threads = []
+        self._log_queue = LogQueue()
+        self.log_output.document().setMaximumBlockCount(MAX_LOG_LINES)
+
         self._load()
 
+        self._scheduler = JobScheduler(self._log_queue, self.workers_spin_box.value())
+        self.workers_spin_box.valueChanged.connect(self._scheduler.set_worker_count)
+
+        self._log_timer = QTimer(self)
+        self._log_timer.timeout.connect(self._drain_log)
+        self._log_timer.timeout.connect(self._update_jobs)
+        self._log_timer.start(LOG_INTERVAL)
 
     def append_log(self, msg):
-        self.log_output.setHtml(self.log_output.toHtml() + msg)
+        self._log_queue.put(msg)
+
+    def _drain_log(self):
+        for record in self._log_queue.drain(LOG_BATCH_SIZE):
+            line = escape(format_record(record))
+            if record.level == ERROR:
+                line = '<span style="color:red;">%s</span>' % line
+            self.log_output.append(line)
+
+    def _update_jobs(self):
+        jobs = self._scheduler.jobs
+        self.jobs_table.setRowCount(len(jobs))
+
+        for row, job in enumerate(jobs):
+            done, total = job.progress
+            values = [job.data_file, job.state, '%d / %d' % (done, total) if total else '']
+
+            for column, value in enumerate(values):
+                item = self.jobs_table.item(row, column)
+                if item is None:
+                    self.jobs_table.setItem(row, column, QTableWidgetItem(value))
+                elif item.text() != value:
+                    item.setText(value)
 
     @pyqtSlot()
     def on_actionExit_triggered(self):
         self.close()
 
+    @pyqtSlot(bool)
+    def on_actionProfile_toggled(self, checked):
+        # enabled with the trace directory once the next files are evaluated
+        if not checked:
+            instrumentation.disable()
+
     @pyqtSlot()
     def on_actionAbout_Qt_triggered(self):
         QMessageBox.aboutQt(self)
@@ -69,17 +99,42 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot()
     def on_evaluate_button_clicked(self):
-        thread = ReportThread(self.output_directory_edit.text(),
-                              [entry.strip() for entry in self.files_line_edit.text().split(';')])
+        output_dir = self.output_directory_edit.text()
+        os.makedirs(output_dir, exist_ok=True)
+        self._log_queue.set_log_file(os.path.join(output_dir, LOG_FILENAME))
 
-        thread.new_log_message.connect(self.append_log)
-        self._threads.append(thread)
+        if self.actionProfile.isChecked():
+            instrumentation.enable(os.path.join(output_dir, TRACE_DIRNAME))
 
-        thread.start()
+        # files which are already queued or running are not scheduled again
+        for entry in self.files_line_edit.text().split(';'):
+            self._scheduler.submit(entry.strip(), output_dir)
+        self._update_jobs()
+
+    @pyqtSlot()
+    def on_cancel_button_clicked(self):
+        jobs = self._scheduler.jobs
+        for index in self.jobs_table.selectionModel().selectedRows():
+            jobs[index.row()].cancel()
+        self._update_jobs()
 
+    @pyqtSlot()
+    def on_cancel_all_button_clicked(self):
+        self._scheduler.cancel_all()
+        self._update_jobs()
+
+    @pyqtSlot()
+    def on_remove_finished_button_clicked(self):
+        self._scheduler.remove_inactive()
+        self.jobs_table.clearSelection()
+        self._update_jobs()
 
     def closeEvent(self, event):
         self._save()
+        self._log_timer.stop()
+        # running notebooks are finished, everything else is cancelled
+        self._scheduler.shutdown()
+        self._log_queue.close()
         return QMainWindow.closeEvent(self, event)
 
     def _handle_eval_button_activation(self):
@@ -88,10 +143,12 @@ class MainWindow(QMainWindow):
     def _save(self):
         settings = self._get_settings_object()
         settings.setValue('output_dir', self.output_directory_edit.text())
+        settings.setValue('workers', self.workers_spin_box.value())
 
     def _load(self):
         settings = self._get_settings_object()
         self.output_directory_edit.setText(settings.value('output_dir', ''))
+        self.workers_spin_box.setValue(int(settings.value('workers', get_default_worker_count())))
 
     def _get_settings_object(self):
         return QSettings('adicht_eval')
\ No newline at end of file
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import threading
+
+from adicht.gui.log import ERROR
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+def get_default_worker_count():
+    """Return the number of workers which keeps all cores busy without oversubscribing them."""
+    # every worker uses the kernels of one reporter
+    from adicht.report.kernels import KERNELS_PER_REPORTER
+
+    return max(1, (os.cpu_count() or 1) // KERNELS_PER_REPORTER)
+
+
+class Job(object):
+    """Report generation of one data file, as scheduled by the JobScheduler."""
+
+    def __init__(self, data_file, output_dir):
+        self._data_file = data_file
+        self._output_dir = output_dir
+        self._cancel_event = threading.Event()
+
+        self.state = QUEUED
+        self.progress = (0, 0)
+        self.error = None
+
+    @property
+    def data_file(self):
+        return self._data_file
+
+    @property
+    def output_dir(self):
+        return self._output_dir
+
+    @property
+    def key(self):
+        return os.path.abspath(self._output_dir), os.path.abspath(self._data_file)
+
+    @property
+    def cancel_event(self):
+        return self._cancel_event
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+    def cancel(self):
+        """Request cancellation, running jobs stop before their next notebook."""
+        self._cancel_event.set()
+
+        if self.state == QUEUED:
+            self.state = CANCELLED
+
+
+class JobScheduler(object):
+    """Runs report jobs on a bounded number of worker threads.
+
+    Jobs are processed in submission order. Submitting a file which is
+    already queued or running for the same output directory returns the
+    existing job. Every worker keeps its reporter (and thereby its warm
+    kernels) as long as consecutive jobs share the output directory.
+    """
+
+    def __init__(self, log_queue, workers=None, reporter_options=None):
+        self._log_queue = log_queue
+        self._reporter_options = reporter_options or {}
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._workers = []
+        self._worker_count = 0
+
+        self.set_worker_count(workers or get_default_worker_count())
+
+    @property
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    @property
+    def worker_count(self):
+        return self._worker_count
+
+    def set_worker_count(self, count):
+        """Change the number of workers, surplus workers stop after their current job."""
+        count = max(count, 1)
+
+        with self._lock:
+            surplus = self._worker_count - count
+            self._worker_count = count
+
+            while len(self._workers) < count:
+                worker = threading.Thread(target=self._work, daemon=True)
+                self._workers.append(worker)
+                worker.start()
+
+        # wake idle workers, so they notice that they are not needed anymore
+        for _ in range(max(surplus, 0)):
+            self._queue.put(None)
+
+    def submit(self, data_file, output_dir):
+        """Queue the report generation of data_file and return its job."""
+        job = Job(data_file, output_dir)
+
+        with self._lock:
+            for entry in self._jobs:
+                if entry.active and not entry.cancel_event.is_set() and entry.key == job.key:
+                    return entry
+            self._jobs.append(job)
+
+        self._queue.put(job)
+        return job
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def remove_inactive(self):
+        """Forget all finished, failed and cancelled jobs."""
+        with self._lock:
+            self._jobs = [job for job in self._jobs if job.active]
+
+    def shutdown(self, wait=True):
+        """Cancel all jobs and stop the workers."""
+        self.cancel_all()
+
+        with self._lock:
+            self._worker_count = 0
+            workers = list(self._workers)
+
+        for _ in workers:
+            self._queue.put(None)
+
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _retire(self):
+        """Remove the calling worker if there are more workers than wanted."""
+        with self._lock:
+            if len(self._workers) > self._worker_count:
+                self._workers.remove(threading.current_thread())
+                return True
+        return False
+
+    def _work(self):
+        reporter = None
+        reporter_dir = None
+
+        try:
+            while not self._retire():
+                job = self._queue.get()
+                if job is None or job.state != QUEUED:
+                    continue
+
+                if reporter is not None and reporter_dir != job.output_dir:
+                    reporter.close()
+                    reporter = None
+                if reporter is None:
+                    reporter = self._create_reporter(job.output_dir)
+                    reporter_dir = job.output_dir
+
+                self._run(reporter, job)
+        finally:
+            if reporter is not None:
+                reporter.close()
+
+    def _run(self, reporter, job):
+        from adicht.report import ReportCancelled
+
+        job.state = RUNNING
+
+        def set_progress(done, total):
+            job.progress = (done, total)
+
+        try:
+            if job.cancel_event.is_set():
+                raise ReportCancelled()
+            reporter.generate_report(job.data_file, cancel_event=job.cancel_event,
+                                     progress_callback=set_progress)
+        except ReportCancelled:
+            job.state = CANCELLED
+            self._log_queue.put('Report for %s cancelled' % job.data_file)
+        except Exception as e:
+            job.error = e
+            job.state = FAILED
+            self._log_queue.put('Report for %s failed: %s' % (job.data_file, e), ERROR)
+        else:
+            job.state = FINISHED
+
+    def _create_reporter(self, output_dir):
+        # the reporting machinery (nbconvert, jupyter) is only needed once reports are generated
+        from adicht.report import Reporter
+
+        return Reporter(output_dir, self._log_queue, **self._reporter_options)
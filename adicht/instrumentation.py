@@ -0,0 +1,359 @@
+# coding: utf-8
+"""Timing and peak memory of the processing stages (loading, evaluation, plotting, export, ...).
+
+Instrumentation is disabled by default. Once enabled, every stage which runs
+within a profile is recorded:
+
+    enable(trace_dir='traces')
+
+    with profile('recording', log_callback):
+        with stage('loadmat'):
+            ...
+
+At the end of the profile, a summary per stage is passed to the log
+callback and (if a trace directory is set) a Chrome trace file is written,
+which can be opened with chrome://tracing or https://ui.perfetto.dev.
+
+tracemalloc only knows a single peak per process, so the peak memory of a
+stage is only reported if no stage of another thread (apart from its
+ancestors) ran at the same time. Overlapping stages and their ancestors
+report no peak memory.
+
+Child processes are enabled via ADICHT_PROFILE (see get_environment).
+Code which runs in several steps without a common context (notebook cells
+in a kernel) is recorded with start_collecting and stop_collecting, the
+events are merged into the profile of the parent with add_events.
+"""
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+import functools
+import contextvars
+from contextlib import nullcontext
+
+
+ENVIRONMENT_VARIABLE = 'ADICHT_PROFILE'
+
+# values of ADICHT_PROFILE
+TIME = 'time'
+MEMORY = 'memory'
+
+_enabled = False
+_trace_dir = None
+
+# the profile of start_collecting
+_collecting_profile = None
+
+# stages which are entered but not exited yet (of all threads)
+_open_stages = set()
+_open_stages_lock = threading.Lock()
+
+_current_profile = contextvars.ContextVar('adicht_profile', default=None)
+_current_stage = contextvars.ContextVar('adicht_stage', default=None)
+
+_NULL_CONTEXT = nullcontext()
+
+
+def enable(trace_dir=None, memory=True):
+    """Enable the instrumentation, traces are written to trace_dir (if given).
+
+    memory enables the tracking of the peak memory (via tracemalloc, which
+    slows the allocations down).
+    """
+    global _enabled, _trace_dir
+
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    _trace_dir = trace_dir
+    _enabled = True
+
+
+def disable():
+    global _enabled, _trace_dir
+
+    _enabled = False
+    _trace_dir = None
+
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _enabled
+
+
+def tracks_memory():
+    """Return whether the peak memory of the stages is tracked."""
+    return _enabled and tracemalloc.is_tracing()
+
+
+def get_environment():
+    """Return the environment variables which enable the instrumentation of child processes like here."""
+    if not _enabled:
+        return {}
+    return {ENVIRONMENT_VARIABLE: MEMORY if tracks_memory() else TIME}
+
+
+def enable_from_environment():
+    """Enable the instrumentation if ADICHT_PROFILE is set (by the parent process)."""
+    value = os.environ.get(ENVIRONMENT_VARIABLE)
+    if value in (TIME, MEMORY):
+        enable(memory=value == MEMORY)
+
+
+def profile(name, log_callback=None, trace_dir=None):
+    """Context manager recording all stages of the enclosed code under the given name.
+
+    Does nothing if the instrumentation is disabled or a profile is already
+    active (the stages are recorded by the outer profile then).
+    """
+    if not _enabled or _current_profile.get() is not None:
+        return _NULL_CONTEXT
+    return Profile(name, log_callback, trace_dir or _trace_dir)
+
+
+def stage(name):
+    """Context manager recording the enclosed code as stage of the current profile."""
+    if not _enabled:
+        return _NULL_CONTEXT
+
+    current = _current_profile.get() or _collecting_profile
+    if current is None:
+        return _NULL_CONTEXT
+    return Stage(current, name)
+
+
+def staged(name):
+    """Decorator recording every call of the decorated function as stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_in_context(executor, func, *args):
+    """Submit func to the executor, stages within func are recorded in the current profile."""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def start_collecting(name):
+    """Record the stages of this process (outside of other profiles) until stop_collecting."""
+    global _collecting_profile
+
+    if _enabled:
+        _collecting_profile = Profile(name)
+        _collecting_profile._start = time.perf_counter()
+
+
+def stop_collecting():
+    """Stop recording, return the events as JSON (start times relative to start_collecting)."""
+    global _collecting_profile
+
+    collected, _collecting_profile = _collecting_profile, None
+    if collected is None:
+        return '[]'
+
+    return json.dumps([
+        (name, start - collected.start, duration, peak_memory, process, thread)
+        for name, start, duration, peak_memory, process, thread in collected.events
+    ])
+
+
+def add_events(events, start):
+    """Add the events of stop_collecting (in another process) to the current profile.
+
+    start is the time (perf_counter) collecting was started at.
+    """
+    current = _current_profile.get()
+    if current is None:
+        return
+
+    for name, offset, duration, peak_memory, process, thread in json.loads(events):
+        current.add(name, start + offset, duration, peak_memory, process, thread)
+
+
+def _get_peak_memory():
+    return tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+
+
+def _get_current_memory():
+    return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+
+class Stage(object):
+    """A (possibly nested) stage of a profile.
+
+    tracemalloc only knows a single peak, so the peak is accumulated over
+    the child stages (which reset it). Stages overlapping with stages of
+    other threads are marked as overlapped and report no peak.
+    """
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+        self._parent = None
+        self._token = None
+        self._start = None
+        self._start_memory = 0
+        self._thread = threading.get_ident()
+        self.peak = 0
+        self.overlapped = False
+
+    def __enter__(self):
+        self._parent = _current_stage.get()
+        if self._parent is not None:
+            self._parent.peak = max(self._parent.peak, _get_peak_memory())
+
+        with _open_stages_lock:
+            ancestors = self._get_ancestors()
+            for entry in _open_stages:
+                if entry._thread != self._thread and entry not in ancestors:
+                    entry._set_overlapped()
+                    self._set_overlapped()
+            _open_stages.add(self)
+
+            # the peak of the other stages is not reset while they are measured
+            if tracemalloc.is_tracing() and not self.overlapped:
+                tracemalloc.reset_peak()
+
+        self._start_memory = _get_current_memory()
+        self._token = _current_stage.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self._start
+        self.peak = max(self.peak, _get_peak_memory())
+
+        with _open_stages_lock:
+            _open_stages.discard(self)
+
+        _current_stage.reset(self._token)
+        if self._parent is not None:
+            self._parent.peak = max(self._parent.peak, self.peak)
+
+        peak = None if self.overlapped or not tracemalloc.is_tracing() else max(self.peak - self._start_memory, 0)
+        self._profile.add(self._name, self._start, duration, peak)
+
+    def _get_ancestors(self):
+        ancestors = set()
+        entry = self._parent
+        while entry is not None:
+            ancestors.add(entry)
+            entry = entry._parent
+        return ancestors
+
+    def _set_overlapped(self):
+        entry = self
+        while entry is not None:
+            entry.overlapped = True
+            entry = entry._parent
+
+
+class Profile(object):
+    """Collects the stages of the processing of one file."""
+
+    def __init__(self, name, log_callback=None, trace_dir=None):
+        self._name = name
+        self._log_callback = log_callback
+        self._trace_dir = trace_dir
+        self._lock = threading.Lock()
+        self._events = []
+        self._token = None
+        self._start = None
+        self._root = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def start(self):
+        """The time (perf_counter) the profile was started at."""
+        return self._start
+
+    @property
+    def events(self):
+        """Read only access to the recorded (name, start, duration, peak memory, process, thread) tuples.
+
+        The peak memory is None if it is unknown (see Stage).
+        """
+        return self._events
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._token = _current_profile.set(self)
+        self._root = Stage(self, 'total').__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._root.__exit__(*exc_info)
+        _current_profile.reset(self._token)
+
+        for line in self.get_summary():
+            self._log(line)
+
+        if self._trace_dir:
+            path = self.write_trace(os.path.join(self._trace_dir, '%s.trace.json' % self._name))
+            self._log('Trace written to %s' % path)
+
+    def add(self, name, start, duration, peak_memory, process=None, thread=None):
+        """Add an event, by default of the current process and thread."""
+        with self._lock:
+            self._events.append((name, start, duration, peak_memory,
+                                 process or os.getpid(), thread or threading.get_ident()))
+
+    def get_summary(self):
+        """Return a line per stage with call count, total duration and maximum (known) peak memory."""
+        stages = {}
+        for name, _, duration, peak_memory, _, _ in self._events:
+            count, total, peak = stages.get(name, (0, 0.0, None))
+            if peak_memory is not None:
+                peak = max(peak or 0, peak_memory)
+            stages[name] = (count + 1, total + duration, peak)
+
+        return [
+            'Profile %s: %-24s %4dx %9.3f s  peak %s' % (
+                self._name, name, count, total, 'unknown' if peak is None else '%8.1f MiB' % (peak / (1024 * 1024)))
+            for name, (count, total, peak) in sorted(stages.items(), key=lambda entry: -entry[1][1])
+        ]
+
+    def get_trace(self):
+        """Return the stages as Chrome trace (complete events, times in microseconds)."""
+        return {
+            'traceEvents': [
+                {
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start - self._start) * 1e6,
+                    'dur': duration * 1e6,
+                    'pid': process,
+                    'tid': thread,
+                    'args': {'peak_memory': peak_memory},
+                }
+                for name, start, duration, peak_memory, process, thread in self._events
+            ],
+            'displayTimeUnit': 'ms',
+            'otherData': {'profile': self._name},
+        }
+
+    def write_trace(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        with open(path, 'w') as f:
+            json.dump(self.get_trace(), f)
+
+        return path
+
+    def _log(self, message):
+        if self._log_callback:
+            self._log_callback(message)
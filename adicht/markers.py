@@ -0,0 +1,104 @@
+# coding: utf-8
+"""Classification of marker texts into the categories the evaluation relies on.
+
+The rules are (category, regular expression) pairs, matched in order
+against the normalized (lower case, stripped) marker text, the first
+matching rule wins. All rules are compiled into a single expression.
+
+Other comment conventions can be configured with a JSON file containing a
+list of {"category": ..., "pattern": ...} objects (the category being the
+lower case name of a MarkerCategory), pointed to by the ADICHT_MARKER_RULES
+environment variable (which also reaches the notebook kernels) or set with
+set_default_classifier.
+"""
+
+import os
+import re
+import json
+from enum import Enum
+
+import numpy
+
+
+STIMULATION_END_MARKER = 'stim ende'
+INTEGRAL_END_MARKER = 'int ende'
+
+RULES_ENVIRONMENT_VARIABLE = 'ADICHT_MARKER_RULES'
+
+
+class MarkerCategory(Enum):
+    OTHER = 0
+    STIMULATION_START = 1
+    STIMULATION_END = 2
+    INTEGRAL_END = 3
+
+
+DEFAULT_RULES = [
+    (MarkerCategory.STIMULATION_START, r'el. stim.*'),
+    (MarkerCategory.STIMULATION_START, r'(.*?)ser(.*)'),
+    (MarkerCategory.STIMULATION_END, re.escape(STIMULATION_END_MARKER)),
+    (MarkerCategory.INTEGRAL_END, re.escape(INTEGRAL_END_MARKER)),
+]
+
+
+def normalize_text(text):
+    return text.lower().strip()
+
+
+def load_rules(filename):
+    """Load classification rules from a JSON file."""
+    with open(filename, 'r') as f:
+        return [
+            (MarkerCategory[entry['category'].upper()], entry['pattern'])
+            for entry in json.load(f)
+        ]
+
+
+class MarkerClassifier(object):
+    """Assigns a MarkerCategory to marker texts according to a list of rules."""
+
+    def __init__(self, rules=DEFAULT_RULES):
+        self._rules = [(MarkerCategory(category), pattern) for category, pattern in rules]
+        self._categories = [category for category, _ in self._rules]
+        self._matcher = re.compile('|'.join(
+            '(?P<rule%d>%s)' % (index, pattern) for index, (_, pattern) in enumerate(self._rules)
+        )) if self._rules else None
+
+    @property
+    def rules(self):
+        """Read only access to the (category, pattern) rules."""
+        return self._rules
+
+    def classify(self, text):
+        """Return the category of the given (not necessarily normalized) text."""
+        match = self._matcher.fullmatch(normalize_text(text)) if self._matcher else None
+        if match is None:
+            return MarkerCategory.OTHER
+        return self._categories[int(match.lastgroup[len('rule'):])]
+
+    def classify_texts(self, texts):
+        """Return the category values of the given texts as array."""
+        return numpy.array([self.classify(entry).value for entry in texts], dtype='i1')
+
+
+_default_classifier = None
+
+
+def get_default_classifier():
+    """Return the classifier used by evaluation and display.
+
+    Uses the rules of the file named by ADICHT_MARKER_RULES if set.
+    """
+    global _default_classifier
+
+    if _default_classifier is None:
+        rules_file = os.environ.get(RULES_ENVIRONMENT_VARIABLE)
+        _default_classifier = MarkerClassifier(load_rules(rules_file) if rules_file else DEFAULT_RULES)
+
+    return _default_classifier
+
+
+def set_default_classifier(classifier):
+    """Use the given classifier for all markers (None restores the default rules)."""
+    global _default_classifier
+    _default_classifier = classifier
@@ -0,0 +1,285 @@
+# coding: utf-8
+
+import struct
+
+import numpy
+
+from adicht.instrumentation import staged
+
+
+# the small variables describing a LabChart export (everything but 'data')
+HEADER_VARIABLES = [
+    'titles',
+    'datastart',
+    'dataend',
+    'samplerate',
+    'firstsampleoffset',
+    'rangemin',
+    'rangemax',
+    'unittext',
+    'unittextmap',
+    'com',
+    'comtext',
+    'tickrate',
+    'blocktimes',
+]
+
+DATA_VARIABLE = 'data'
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+# MAT v5 data element types
+MI_MATRIX = 14
+MI_COMPRESSED = 15
+MI_TYPES = {
+    1: 'i1',
+    2: 'u1',
+    3: 'i2',
+    4: 'u2',
+    5: 'i4',
+    6: 'u4',
+    7: 'f4',
+    9: 'f8',
+    12: 'i8',
+    13: 'u8',
+}
+MX_COMPLEX_FLAG = 0x800
+
+
+def is_hdf5_matfile(filename):
+    """Check whether the given file is a MAT v7.3 (HDF5 based) file."""
+    with open(filename, 'rb') as f:
+        f.seek(512)
+        return f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE
+
+
+@staged('loadmat')
+def load_variables(filename, variable_names=None):
+    """Load variables of a MAT file in the format scipy's loadmat would return them.
+
+    v7.3 files are read via h5py (which is only imported if needed).
+    """
+    if not is_hdf5_matfile(filename):
+        from scipy.io import loadmat
+        return loadmat(filename, variable_names=variable_names)
+
+    import h5py
+
+    with h5py.File(filename, 'r') as f:
+        return {
+            name: _convert_hdf5_variable(f[name])
+            for name in (variable_names or f.keys())
+            if name in f and isinstance(f[name], h5py.Dataset)
+        }
+
+
+def open_data_source(filename):
+    """Open the data vector of a MAT file for ranged access without loading it.
+
+    Uses a chunked h5py dataset for v7.3 files and a memory map for
+    uncompressed v5 files. Compressed v5 files cannot be accessed partially,
+    so the vector is loaded completely on first access.
+    """
+    if is_hdf5_matfile(filename):
+        return HDF5DataSource(filename, DATA_VARIABLE)
+
+    location = _locate_v5_variable(filename, DATA_VARIABLE)
+    if location is not None:
+        return MemoryMappedDataSource(filename, *location)
+
+    return DeferredDataSource(
+        lambda: load_variables(filename, [DATA_VARIABLE])[DATA_VARIABLE])
+
+
+class MatlabContent(dict):
+    """Dict of MAT file variables which loads missing variables on first access."""
+
+    def __init__(self, filename, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._filename = filename
+
+    def __missing__(self, key):
+        variables = load_variables(self._filename, [key])
+        if key not in variables:
+            raise KeyError(key)
+        self[key] = variables[key]
+        return self[key]
+
+
+class DataSource(object):
+    """Base class for ranged access to the (flattened) data vector of a MAT file.
+
+    Data sources can be used as context managers, which close them.
+    """
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, start, stop):
+        """Return the samples in [start, stop) as 1D float array."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources of the data source (the samples cannot be read afterwards)."""
+
+
+class ArrayDataSource(DataSource):
+    """Data source for a data vector that is already in memory."""
+
+    def __init__(self, data):
+        self._data = numpy.ravel(data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, start, stop):
+        return self._data[start:stop]
+
+
+class DeferredDataSource(DataSource):
+    """Data source which loads the complete data vector on first access."""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._data = None
+
+    def __len__(self):
+        return len(self._get_data())
+
+    def read(self, start, stop):
+        return self._get_data()[start:stop]
+
+    def _get_data(self):
+        if self._data is None:
+            self._data = numpy.ravel(self._loader())
+        return self._data
+
+
+class MemoryMappedDataSource(DataSource):
+    """Data source memory mapping the raw data of an uncompressed v5 variable."""
+
+    def __init__(self, filename, offset, dtype, length):
+        self._data = numpy.memmap(filename, mode='r', dtype=dtype, offset=offset,
+                                  shape=(length,))
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, start, stop):
+        return numpy.asarray(self._data[start:stop], dtype=float)
+
+
+class HDF5DataSource(DataSource):
+    """Data source reading chunks of a v7.3 (HDF5) variable on demand."""
+
+    def __init__(self, filename, name):
+        import h5py
+
+        self._file = h5py.File(filename, 'r')
+        self._dataset = self._file[name]
+
+    def __len__(self):
+        return self._dataset.size
+
+    def read(self, start, stop):
+        # matlab vectors are stored transposed, so either axis may be the long one
+        if self._dataset.shape[0] == 1:
+            return self._dataset[0, start:stop].astype(float)
+        return self._dataset[start:stop, 0].astype(float)
+
+    def close(self):
+        self._file.close()
+
+
+def _convert_hdf5_variable(dataset):
+    value = dataset[()]
+    matlab_class = dataset.attrs.get('MATLAB_class', b'')
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode('ascii')
+
+    if matlab_class == 'char':
+        return numpy.array([
+            ''.join(map(chr, row)) for row in numpy.atleast_2d(value.T)
+        ])
+
+    # hdf5 stores the column major matlab arrays transposed
+    return numpy.atleast_2d(value.T)
+
+
+def _locate_v5_variable(filename, name):
+    """Find offset, dtype and length of an uncompressed real vector in a v5 MAT file.
+
+    Returns None if the variable can not be memory mapped.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(128)
+        if len(header) < 128:
+            return None
+        endian = '<' if header[126:128] == b'IM' else '>'
+
+        position = 128
+        while True:
+            f.seek(position)
+            tag = f.read(8)
+            if len(tag) < 8:
+                return None
+            mdtype, nbytes = struct.unpack(endian + 'II', tag)
+            next_position = position + 8 + nbytes
+
+            if mdtype == MI_MATRIX:
+                result = _parse_v5_matrix(f, endian, position + 8, name)
+                if result is not None:
+                    return result
+
+            position = next_position
+
+
+def _read_v5_element(f, endian):
+    """Read a data element tag and return type, size and data offset."""
+    position = f.tell()
+    mdtype, nbytes = struct.unpack(endian + 'II', f.read(8))
+
+    if mdtype >> 16:
+        # small data element format: data is stored within the tag
+        f.seek(position + 8)
+        return mdtype & 0xffff, mdtype >> 16, position + 4
+
+    f.seek(position + 8 + ((nbytes + 7) // 8) * 8)
+    return mdtype, nbytes, position + 8
+
+
+def _parse_v5_matrix(f, endian, position, name):
+    f.seek(position)
+
+    _, _, flags_offset = _read_v5_element(f, endian)
+    _, dims_size, dims_offset = _read_v5_element(f, endian)
+    _, name_size, name_offset = _read_v5_element(f, endian)
+    data_position = f.tell()
+
+    f.seek(name_offset)
+    if f.read(name_size).decode('ascii', 'replace') != name:
+        return None
+
+    f.seek(flags_offset)
+    flags = struct.unpack(endian + 'I', f.read(4))[0]
+    if flags & MX_COMPLEX_FLAG:
+        return None
+
+    f.seek(dims_offset)
+    dims = struct.unpack(endian + '%di' % (dims_size // 4), f.read(dims_size))
+    if len(dims) != 2 or min(dims) != 1:
+        return None
+
+    f.seek(data_position)
+    mdtype, nbytes, data_offset = _read_v5_element(f, endian)
+    if mdtype not in MI_TYPES:
+        return None
+
+    dtype = numpy.dtype(endian + MI_TYPES[mdtype])
+    return data_offset, dtype, nbytes // dtype.itemsize
@@ -0,0 +1,213 @@
+# coding: utf-8
+"""Parallel evaluation of the channels of one file in worker processes.
+
+The channels of a file share one data vector. It is handed to the workers
+without pickling: files opened from the cache are memory maps already (the
+workers map the same .npy file), otherwise the vector is copied once into
+shared memory. The workers only get the channel parameters and markers and
+return the evaluation results, which are attached to Stimulation objects of
+the original channels (in channel order):
+
+    for channel, stimulations in zip(channels, get_evaluated_channels(data_file, channels, workers=4)):
+        ...
+
+The number of workers defaults to the ADICHT_EVALUATION_WORKERS environment
+variable (which also reaches the notebook kernels), by default the channels
+are evaluated serially.
+"""
+
+import os
+
+import numpy
+
+from adicht.data import Channel
+from adicht.evaluation import IntegrationMethod, Stimulation, get_evaluated_stimulations
+from adicht.instrumentation import stage
+from adicht.markers import get_default_classifier, set_default_classifier
+
+
+WORKERS_ENVIRONMENT_VARIABLE = 'ADICHT_EVALUATION_WORKERS'
+
+# samples copied at once into the shared memory (for lazily loaded files)
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# result attributes of a Stimulation, transferred back from the workers
+RESULTS = ('duration', 'max_value', 'integral_end_time',
+           'stimulation_answer_integrated', 'full_answer_integrated')
+
+
+def get_evaluated_channels(data_file, channels=None, workers=None, method=IntegrationMethod.TRAPEZOID):
+    """Evaluate the stimulations of the given channels (by default all channels of all blocks).
+
+    Returns a list of evaluated stimulations per channel, like
+    get_evaluated_stimulations. With more than one worker, the channels are
+    evaluated in worker processes.
+    """
+    if channels is None:
+        channels = [channel for block in data_file.blocks for channel in block.channels]
+    if workers is None:
+        workers = get_default_workers()
+
+    pending = [channel for channel in channels if channel.sample_count]
+    workers = min(workers, len(pending))
+
+    if workers <= 1:
+        return [get_evaluated_stimulations(channel, method) if channel.sample_count else []
+                for channel in channels]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with stage('evaluate_channels'), SharedData(data_file) as shared_data, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker,
+                                initargs=(get_default_classifier(),)) as executor:
+        results = executor.map(
+            _evaluate_channel,
+            [shared_data.spec] * len(pending),
+            [_describe_channel(channel) for channel in pending],
+            [method] * len(pending))
+        results = dict(zip(map(id, pending), results))
+
+    return [
+        [_create_stimulation(channel, entry) for entry in results[id(channel)]] if channel.sample_count else []
+        for channel in channels
+    ]
+
+
+def get_default_workers(variable=WORKERS_ENVIRONMENT_VARIABLE):
+    """Return the number of worker processes set via the environment variable (1 if not set).
+
+    By default ADICHT_EVALUATION_WORKERS, other pools pass their own variable.
+    """
+    try:
+        return max(int(os.environ.get(variable, 1)), 1)
+    except ValueError:
+        return 1
+
+
+class SharedData(object):
+    """Makes the data vector of a file accessible to other processes (as context manager).
+
+    spec describes how to open the vector, see open_shared_data.
+    """
+
+    def __init__(self, data_file):
+        self._data_file = data_file
+        self._memory = None
+        self._spec = None
+
+    @property
+    def spec(self):
+        return self._spec
+
+    def __enter__(self):
+        data = None if self._data_file.lazy else self._data_file.raw_content['data']
+
+        if isinstance(data, numpy.memmap) and data.filename and data.flags.c_contiguous:
+            self._spec = ('mmap', data.filename, data.offset, data.dtype.str, data.size)
+            return self
+
+        from multiprocessing import shared_memory
+
+        source = self._data_file.data_source
+        length = len(source)
+        dtype = numpy.dtype(data.dtype if data is not None else source.read(0, 1).dtype)
+
+        self._memory = shared_memory.SharedMemory(create=True, size=max(length * dtype.itemsize, 1))
+        try:
+            target = numpy.ndarray(length, dtype=dtype, buffer=self._memory.buf)
+            for start in range(0, length, COPY_CHUNK_SIZE):
+                target[start:start + COPY_CHUNK_SIZE] = source.read(start, start + COPY_CHUNK_SIZE)
+            del target
+        except BaseException:
+            self._release()
+            raise
+
+        self._spec = ('shm', self._memory.name, 0, dtype.str, length)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        if self._memory is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+
+# the data vector opened by a worker process: (spec, shared memory, array)
+_opened_data = None
+
+
+def open_shared_data(spec):
+    """Return the data vector described by the spec of a SharedData object.
+
+    The vector stays open (for the following channels) until another one is
+    opened.
+    """
+    global _opened_data
+
+    if _opened_data is not None and _opened_data[0] == spec:
+        return _opened_data[2]
+
+    kind, name, offset, dtype, length = spec
+    memory = None
+
+    if kind == 'mmap':
+        data = numpy.memmap(name, mode='r', dtype=dtype, offset=offset, shape=(length,))
+    else:
+        from multiprocessing import shared_memory
+
+        # workers share the resource tracker of the creating process, which unlinks the memory
+        memory = shared_memory.SharedMemory(name=name)
+        data = numpy.ndarray(length, dtype=dtype, buffer=memory.buf)
+
+    if _opened_data is not None and _opened_data[1] is not None:
+        try:
+            _opened_data[1].close()
+        except BufferError:
+            # views of the previous vector are still referenced, closed on collection then
+            pass
+
+    _opened_data = (spec, memory, data)
+    return data
+
+
+def _initialize_worker(classifier):
+    set_default_classifier(classifier)
+
+
+def _describe_channel(channel):
+    """Return the arguments to create the channel (without its data) in a worker."""
+    return dict(
+        rangemin=channel.rangemin,
+        rangemax=channel.rangemax,
+        samplerate=channel.samplerate,
+        title=channel.title,
+        unit=channel.unit,
+        offset=channel.offset,
+        markers=channel.markers,
+        data_range=channel.data_range,
+        block=channel.block,
+    )
+
+
+def _evaluate_channel(spec, description, method):
+    from adicht.matfile import ArrayDataSource
+
+    channel = Channel(data=None, source=ArrayDataSource(open_shared_data(spec)), **description)
+
+    return [
+        (entry.start_index, entry.stop_index) + entry.marker_rows +
+        tuple(getattr(entry, name) for name in RESULTS)
+        for entry in get_evaluated_stimulations(channel, method)
+    ]
+
+
+def _create_stimulation(channel, result):
+    stimulation = Stimulation(channel, *result[:4])
+
+    for name, value in zip(RESULTS, result[4:]):
+        setattr(stimulation, name, value)
+
+    return stimulation
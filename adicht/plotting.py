@@ -0,0 +1,171 @@
+# coding: utf-8
+"""Off-screen rendering of figures to PNG or SVG images.
+
+A Plot only describes a figure (lines, vertical markers, labels), so it can
+be sent to worker processes. The figures are drawn with the object
+oriented matplotlib API on the Agg canvas, pyplot and its global figure
+registry are not involved. Every thread reuses one figure per size, which
+is cleared after each image:
+
+    plot = Plot(xlabel='s', ylabel='mV')
+    plot.add_line(times, values)
+    png_data = render_plot(plot)
+
+PlotRenderer renders a stream of plots in a pool of worker processes (see
+ADICHT_PLOT_WORKERS), keeping only a bounded number of them in flight.
+"""
+
+import threading
+from io import BytesIO
+from collections import deque
+
+from adicht.instrumentation import staged
+from adicht.parallel import get_default_workers
+
+
+PNG = 'png'
+SVG = 'svg'
+FORMATS = [PNG, SVG]
+
+DEFAULT_SIZE = (15, 5)
+
+WORKERS_ENVIRONMENT_VARIABLE = 'ADICHT_PLOT_WORKERS'
+
+# plots rendered ahead per worker
+PENDING_PER_WORKER = 4
+
+_local = threading.local()
+
+
+class Plot(object):
+    """Description of a figure with a single axes."""
+
+    def __init__(self, size=DEFAULT_SIZE, xlabel='', ylabel=''):
+        self.size = tuple(size)
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.lines = []
+        self.vertical_lines = []
+        self.legend = None
+
+    def add_line(self, x, y, **kwargs):
+        """Add a line plot, kwargs are passed to Axes.plot."""
+        self.lines.append((x, y, kwargs))
+
+    def add_vertical_line(self, x, **kwargs):
+        """Add a vertical line, kwargs are passed to Axes.axvline."""
+        self.vertical_lines.append((x, kwargs))
+
+    def set_legend(self, **kwargs):
+        """Show a legend, kwargs are passed to Axes.legend."""
+        self.legend = kwargs
+
+    def draw(self, axes):
+        """Draw the plot to the given matplotlib axes."""
+        for x, y, kwargs in self.lines:
+            axes.plot(x, y, **kwargs)
+        for x, kwargs in self.vertical_lines:
+            axes.axvline(x=x, **kwargs)
+
+        axes.set_xlabel(self.xlabel)
+        axes.set_ylabel(self.ylabel)
+
+        if self.legend is not None:
+            axes.legend(**self.legend)
+
+
+def get_figure(size):
+    """Return the figure of the current thread for the given size (created on first use)."""
+    figures = getattr(_local, 'figures', None)
+    if figures is None:
+        figures = _local.figures = {}
+
+    if size not in figures:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        figure = Figure(figsize=size)
+        FigureCanvasAgg(figure)
+        figures[size] = figure
+
+    return figures[size]
+
+
+@staged('render_figure')
+def render_plot(plot, format=PNG):
+    """Render the plot to an image in the given format, return the image data."""
+    figure = get_figure(plot.size)
+
+    try:
+        plot.draw(figure.add_subplot(111))
+
+        buffer = BytesIO()
+        # without a date, the same plot always gives the same image
+        figure.savefig(buffer, format=format, bbox_inches='tight',
+                       metadata={'Date': None} if format == SVG else None)
+        return buffer.getvalue()
+    finally:
+        figure.clear()
+
+
+class PlotRenderer(object):
+    """Renders plots in a pool of worker processes (in-process with a single worker)."""
+
+    def __init__(self, workers=None, format=PNG):
+        self._workers = workers or get_default_workers(WORKERS_ENVIRONMENT_VARIABLE)
+        self._format = format
+        self._executor = None
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def format(self):
+        return self._format
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def render(self, plot):
+        return render_plot(plot, self._format)
+
+    def render_all(self, items):
+        """Yield the given items in order, with the Plot objects among them replaced by their images.
+
+        Plots are rendered ahead in the workers while the other items are
+        consumed, at most PENDING_PER_WORKER per worker.
+        """
+        if self._workers <= 1:
+            for item in items:
+                yield self.render(item) if isinstance(item, Plot) else item
+            return
+
+        pending = deque()
+        for item in items:
+            pending.append(self._submit(item) if isinstance(item, Plot) else item)
+            while len(pending) > self._workers * PENDING_PER_WORKER:
+                yield self._resolve(pending.popleft())
+
+        while pending:
+            yield self._resolve(pending.popleft())
+
+    def _submit(self, plot):
+        if self._executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        return self._executor.submit(render_plot, plot, self._format)
+
+    def _resolve(self, item):
+        from concurrent.futures import Future
+
+        return item.result() if isinstance(item, Future) else item
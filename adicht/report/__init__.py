@@ -1,59 +1,207 @@
 # -*- coding: utf-8 -*-
 
 import os
-
-from jinja2 import Template
-import nbformat
-
-from nbconvert.preprocessors import ExecutePreprocessor
-from nbconvert import HTMLExporter, PDFExporter, NotebookExporter
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import adicht
+from adicht.document import Document, render_to
+from adicht.cache import file_digest, get_default_cache
+from adicht.instrumentation import profile, run_in_context, stage, staged
+from adicht.report.assets import ASSETS_DIRNAME, EXTERNAL, INLINE, AssetStore, externalize_images
+from adicht.report.kernels import KERNELS_PER_REPORTER, KernelPool, collect_stages
+from adicht.report.manifest import BuildManifest, get_code_version, get_rules_version
 
 SRC_DIR = os.path.join(os.path.dirname(adicht.__file__), '..')
 
 def generate_reports(data_file, output_dir):
     pass
 
+class ReportCancelled(Exception):
+    """Raised by Reporter.generate_report if the generation was cancelled."""
+
+
 class Reporter(object):
     OUTPUT_DIRS = ['raw', 'interpreted', 'evaluated']
     TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
 
-    def __init__(self, output_dir, log_callback=None):
+    KERNEL_MODE = 'kernel'
+    DIRECT_MODE = 'direct'
+
+    INLINE_ASSETS = INLINE
+    EXTERNAL_ASSETS = EXTERNAL
+
+    def __init__(self, output_dir, log_callback=None, mode=KERNEL_MODE, exports=('.ipynb', '.html'),
+                 kernels=KERNELS_PER_REPORTER, concurrency=3, assets=INLINE_ASSETS):
+        """Create a reporter writing to output_dir.
+
+        In kernel mode the notebooks are executed by a pool of (at most
+        kernels) warm jupyter kernels and exported afterwards. Up to
+        concurrency notebooks of a file are executed at the same time. In
+        direct mode the reports are rendered in-process and written straight
+        to the given exports, no kernel is started.
+
+        With EXTERNAL_ASSETS, the images of the HTML exports are written to
+        the assets directory of output_dir (named by their content, shared by
+        all reports) instead of being inlined, see adicht.report.assets.
+
+        Call close to shut the kernels down once all reports are generated.
+        """
         self._output_dir = output_dir
         self._templates = self._get_templates()
+        self._mode = mode
+        self._exports = exports
+        self._concurrency = max(concurrency, 1)
+        self._kernel_pool = KernelPool(SRC_DIR, kernels) if kernels else None
+        self._asset_store = AssetStore(os.path.join(output_dir, ASSETS_DIRNAME)) \
+            if assets == self.EXTERNAL_ASSETS else None
 
         self._log_callback = log_callback
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._kernel_pool is not None:
+            self._kernel_pool.shutdown()
+
     def _log(self, message):
         if self._log_callback:
             self._log_callback(message)
 
-    def generate_report(self, data_file):
+    def generate_report(self, data_file, force=False, cancel_event=None, progress_callback=None):
+        """Generate the reports for the given file.
+
+        Reports which are up to date according to the build manifest of the
+        target directory are skipped unless force is given.
+
+        If the (threading.Event) cancel_event is set, no further notebook is
+        started and ReportCancelled is raised once the running ones are done.
+        progress_callback is called with the number of finished and the total
+        number of notebooks.
+        """
         self._log('Generate report for %s' % data_file)
-        self._generate_notebooks(data_file)
+        with profile(os.path.splitext(os.path.basename(data_file))[0], self._log):
+            self._generate_notebooks(data_file, force, cancel_event, progress_callback)
         self._log('Report for %s finished!' % data_file)
 
-    def _generate_notebooks(self, data_file):
+    def _generate_notebooks(self, data_file, force=False, cancel_event=None, progress_callback=None):
         target_dir = self._get_target_directory(data_file)
+        manifest = BuildManifest(target_dir)
+        with stage('hash_input'):
+            input_digest = manifest.get_input_digest(data_file)
+
+        lock = threading.Lock()
+        progress = [0, len(self._templates)]
+
+        def check_cancelled():
+            if cancel_event is not None and cancel_event.is_set():
+                raise ReportCancelled('Report for %s cancelled' % data_file)
+
+        def advance():
+            with lock:
+                progress[0] += 1
+                if progress_callback:
+                    progress_callback(*progress)
 
+        notebooks = []
         for template, template_sub_dir in self._templates:
-            template_target_dir = os.path.join(target_dir , template_sub_dir)
-            os.makedirs(template_target_dir, exist_ok=True)
+            template_target_dir = os.path.join(target_dir, template_sub_dir)
+            hashes = self._get_build_hashes(input_digest, template)
+
+            if not force and manifest.is_up_to_date(
+                    template_sub_dir, hashes, self._get_output_files(template, template_target_dir)):
+                self._log('Notebook %s is up to date' % os.path.join(template_target_dir, os.path.basename(template)))
+                advance()
+                continue
+
+            notebooks.append((self._create_notebook(data_file, template, template_target_dir),
+                              template_sub_dir, hashes))
+
+        if notebooks and get_default_cache() is not None:
+            self._warm_cache(data_file)
+
+        def finish(notebook, template_sub_dir, hashes):
+            self._export_notebook(notebook)
+            manifest.update(template_sub_dir, hashes, data_file)
+            advance()
+
+        if self._mode == self.DIRECT_MODE:
+            # rendered one after another, the plots of each report are spread over the plot workers
+            # (ADICHT_PLOT_WORKERS) instead
+            for notebook, template_sub_dir, hashes in notebooks:
+                check_cancelled()
+                self._log('Render notebook %s' % notebook.path)
+                notebook.render(template_sub_dir, data_file)
+                finish(notebook, template_sub_dir, hashes)
+        else:
+            def execute(entry):
+                # notebooks which are already running are finished, cancelling stops between notebooks
+                check_cancelled()
+                self._execute_notebook(entry[0])
+                finish(*entry)
 
-            with open(template, 'r') as f:
-                template_content = f.read()
+            with ThreadPoolExecutor(self._concurrency) as executor:
+                # result() to propagate exceptions of the executions
+                for future in [run_in_context(executor, execute, entry) for entry in notebooks]:
+                    future.result()
 
-            output_file = os.path.join(template_target_dir, os.path.basename(template))
-            with open(output_file, 'w') as f:
-                self._log('Generate notebook %s' % output_file)
-                f.write(Template(template_content).render(data_file_path=data_file))
+    @staged('warm_cache')
+    def _warm_cache(self, data_file):
+        """Parse the file once, the notebooks open the cached content (instead of all parsing it at once)."""
+        from adicht.data import ADichtMatlabFile
 
-            noteook = Notebook(output_file, self._log)
-            self._log('Execute notebook %s' % output_file)
-            noteook.execute()
-            self._log('Export notebook %s' % output_file)
-            noteook.export()
+        ADichtMatlabFile(data_file)
+
+    def _get_build_hashes(self, input_digest, template):
+        hashes = {
+            'input': input_digest,
+            'template': file_digest(template),
+            'code': get_code_version(),
+            # the marker rules change the evaluation as much as the code
+            'rules': get_rules_version(),
+            'mode': self._mode,
+        }
+        if self._asset_store is not None:
+            hashes['assets'] = self.EXTERNAL_ASSETS
+        return hashes
+
+    def _get_output_files(self, template, target_dir):
+        file_base = os.path.join(target_dir, os.path.splitext(os.path.basename(template))[0])
+        return ['%s%s' % (file_base, ext) for ext in self._exports]
+
+    @staged('create_notebook')
+    def _create_notebook(self, data_file, template, target_dir):
+        from jinja2 import Template
+
+        os.makedirs(target_dir, exist_ok=True)
+
+        with open(template, 'r') as f:
+            template_content = f.read()
+
+        output_file = os.path.join(target_dir, os.path.basename(template))
+        with open(output_file, 'w') as f:
+            self._log('Generate notebook %s' % output_file)
+            f.write(Template(template_content).render(data_file_path=data_file))
+
+        return Notebook(output_file, self._log, self._asset_store)
+
+    def _execute_notebook(self, notebook):
+        self._log('Execute notebook %s' % notebook.path)
+
+        if self._kernel_pool is None:
+            notebook.execute()
+        else:
+            with self._kernel_pool.kernel() as kernel:
+                notebook.execute(kernel)
+
+    def _export_notebook(self, notebook):
+        self._log('Export notebook %s' % notebook.path)
+        notebook.export(exports=self._exports)
 
     def _get_target_directory(self, data_file):
         return os.path.join(self._output_dir, os.path.splitext(os.path.basename(data_file))[0])
@@ -66,36 +214,95 @@ class Reporter(object):
 
 
 class Notebook(object):
-    def __init__(self, notebook_path, log_callback):
+    def __init__(self, notebook_path, log_callback, asset_store=None):
+        """asset_store receives the images of the HTML export (they are inlined without)."""
         self._path = notebook_path
         self._content = self._load()
+        self._document = None
         self._log_callback = log_callback
+        self._asset_store = asset_store
+
+    @property
+    def path(self):
+        return self._path
 
-    def execute(self):
-        proc = ExecutePreprocessor()
-        proc.preprocess(self._content, {'metadata': {'path': SRC_DIR}})
+    @staged('execute_notebook')
+    def execute(self, kernel=None):
+        """Execute the notebook in a new kernel or in the given (kernel manager, client) tuple."""
+        if kernel is None:
+            from nbconvert.preprocessors import ExecutePreprocessor
 
-    def export(self, output_dir=None):
+            proc = ExecutePreprocessor()
+            proc.preprocess(self._content, {'metadata': {'path': SRC_DIR}})
+            return
+
+        from nbclient import NotebookClient
+
+        client = NotebookClient(self._content, km=kernel[0], resources={'metadata': {'path': SRC_DIR}})
+        client.kc = kernel[1]
+        with collect_stages(kernel, os.path.basename(self._path)):
+            client.execute()
+
+    @staged('render_notebook')
+    def render(self, report_name, data_file):
+        """Render the report in-process instead of executing the notebook.
+
+        Calls generate_report of the adicht.report module with the given name
+        and stores its output in the notebook.
+        """
+        self._document = Document(os.path.basename(self._path.rpartition('.')[0]))
+
+        with render_to(self._document):
+            importlib.import_module('adicht.report.%s' % report_name).generate_report(data_file)
+
+        self._content = self._document.to_notebook(self._content)
+
+    def export(self, output_dir=None, exports=None):
         if output_dir is None:
             output_dir = os.path.dirname(self._path)
 
         file_base = os.path.join(output_dir, os.path.basename(self._path.rpartition('.')[0]))
 
         for ext, func in self.exports.items():
+            if exports is not None and ext not in exports:
+                continue
             self._log('Export %s' % ext)
             with open('%s%s' % (file_base, ext), 'w') as f:
-                f.write(str(func(self)))
+                f.write(str(func(self, output_dir)))
 
-    def to_notebook(self):
+    @staged('export_ipynb')
+    def to_notebook(self, output_dir=None):
+        from nbconvert import NotebookExporter
         return NotebookExporter().from_notebook_node(self._content)[0]
 
-    def to_html(self):
-        return HTMLExporter().from_notebook_node(self._content)[0]
+    @staged('export_html')
+    def to_html(self, output_dir=None):
+        """Return the HTML export, the asset URLs are relative to output_dir (the notebook directory by default)."""
+        base_dir = output_dir or os.path.dirname(self._path)
+
+        # rendered documents are written directly, without the nbconvert machinery
+        if self._document is not None:
+            if self._asset_store is None:
+                return self._document.to_html()
+            return self._document.to_html(
+                lambda data, mime_type: self._asset_store.get_image_tag(data, mime_type, base_dir))
+
+        content = self._content
+        if self._asset_store is not None:
+            with stage('externalize_images'):
+                content = externalize_images(content, self._asset_store, base_dir)
 
-    def to_pdf(self):
+        from nbconvert import HTMLExporter
+        return HTMLExporter().from_notebook_node(content)[0]
+
+    @staged('export_pdf')
+    def to_pdf(self, output_dir=None):
+        from nbconvert import PDFExporter
         return PDFExporter().from_notebook_node(self._content)[0]
 
     def _load(self):
+        import nbformat
+
         with open(self._path, 'r') as f:
             return nbformat.read(f, as_version=4)
 
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Content addressed storage of the report images for HTML exports.
+
+In the external asset mode, the images of the HTML reports are not inlined
+as base64 but written to the assets directory of the output directory,
+named by the hash of their content. Images which are the same in several
+reports are stored once. The HTML refers to them with relative, lazily
+loaded img tags, so the output directory can be moved as a whole.
+"""
+
+import os
+import base64
+import uuid
+import hashlib
+from copy import deepcopy
+
+from adicht.document import PNG_MIME_TYPE, SVG_MIME_TYPE
+
+
+INLINE = 'inline'
+EXTERNAL = 'external'
+MODES = [INLINE, EXTERNAL]
+
+ASSETS_DIRNAME = 'assets'
+
+EXTENSIONS = {
+    PNG_MIME_TYPE: '.png',
+    SVG_MIME_TYPE: '.svg',
+}
+
+IMAGE_TAG = '<img src="%s" loading="lazy" alt="">'
+
+
+class AssetStore(object):
+    """Writes images to a directory, named by their content hash."""
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def store(self, data, mime_type=PNG_MIME_TYPE):
+        """Store the image data (if not stored yet) and return its path."""
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        path = os.path.join(self._directory, '%s%s' % (digest, EXTENSIONS[mime_type]))
+
+        if not os.path.exists(path):
+            os.makedirs(self._directory, exist_ok=True)
+            # written under a unique temporary name, other reports may store the same image meanwhile
+            # (opened like the reports, mkstemp would make the asset readable by the owner only)
+            tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+            try:
+                with open(tmp_path, 'xb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        return path
+
+    def get_url(self, data, mime_type, base_dir):
+        """Store the image and return its URL relative to base_dir (the directory of the HTML file)."""
+        path = os.path.relpath(self.store(data, mime_type), base_dir)
+        return path.replace(os.sep, '/')
+
+    def get_image_tag(self, data, mime_type, base_dir):
+        return IMAGE_TAG % self.get_url(data, mime_type, base_dir)
+
+
+def externalize_images(notebook, asset_store, base_dir):
+    """Return a copy of the notebook with its image outputs replaced by img tags to stored assets."""
+    notebook = deepcopy(notebook)
+
+    for cell in notebook.cells:
+        for output in cell.get('outputs', []):
+            data = output.get('data', {})
+            images = [(mime_type, data.pop(mime_type)) for mime_type in EXTENSIONS if mime_type in data]
+
+            if images:
+                mime_type, content = images[0]
+                data['text/html'] = asset_store.get_image_tag(_decode(mime_type, content), mime_type, base_dir)
+
+    return notebook
+
+
+def _decode(mime_type, content):
+    # notebooks store binary images base64 encoded, SVG as (possibly split) text
+    if mime_type == PNG_MIME_TYPE:
+        return base64.b64decode(content)
+    return (''.join(content) if isinstance(content, list) else content).encode('utf-8')
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import os
+import ast
+import time
+import weakref
+import threading
+from contextlib import contextmanager
+
+from adicht import instrumentation
+from adicht.instrumentation import stage, staged
+
+
+# imported once per kernel instead of once per notebook
+PRELOAD_CODE = '''
+import matplotlib.pyplot
+import scipy.io
+import adicht.instrumentation
+import adicht.data
+import adicht.evaluation
+import adicht.display
+import adicht.report.raw
+import adicht.report.interpreted
+import adicht.report.evaluated
+
+adicht.instrumentation.enable_from_environment()
+'''
+
+# kernels of a pool outlive the enabling of the instrumentation, so it is enabled per notebook as well
+COLLECT_CODE = '''
+import adicht.instrumentation
+adicht.instrumentation.enable(memory=%r)
+adicht.instrumentation.start_collecting(%r)
+'''
+COLLECTED_EXPRESSION = 'adicht.instrumentation.stop_collecting()'
+DISABLE_CODE = '''
+import adicht.instrumentation
+adicht.instrumentation.disable()
+'''
+
+# clients of the kernels with enabled instrumentation, disabled once the parent disables it
+_instrumented_kernels = weakref.WeakSet()
+
+STARTUP_TIMEOUT = 60
+
+# kernels of the pool of a reporter, a batch job or GUI worker uses one reporter
+KERNELS_PER_REPORTER = 3
+
+
+class KernelPool(object):
+    """Bounded pool of warm jupyter kernels which are reused across notebooks.
+
+    Kernels are started on demand (up to size kernels), the adicht modules
+    are imported right after startup. A kernel which died while in use is
+    replaced by a new one (started by the next thread needing a kernel).
+    """
+
+    def __init__(self, cwd, size=KERNELS_PER_REPORTER, preload_code=PRELOAD_CODE):
+        self._cwd = cwd
+        self._size = size
+        self._preload_code = preload_code
+
+        self._condition = threading.Condition()
+        self._idle = []
+        self._kernels = []
+        # kernels which are running or starting
+        self._count = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @contextmanager
+    def kernel(self):
+        """Context manager providing a (kernel manager, kernel client) tuple of the pool."""
+        with stage('acquire_kernel'):
+            kernel = self._acquire()
+
+        try:
+            yield kernel
+        finally:
+            if kernel[0].is_alive():
+                self._release(kernel)
+            else:
+                self._discard(kernel)
+
+    def shutdown(self):
+        with self._condition:
+            kernels, self._kernels = self._kernels, []
+            self._idle = []
+            self._count -= len(kernels)
+            self._condition.notify_all()
+
+        for km, kc in kernels:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._count >= self._size:
+                self._condition.wait()
+
+            if self._idle:
+                return self._idle.pop()
+
+            # reserve the slot while the kernel starts
+            self._count += 1
+
+        try:
+            kernel = self._start_kernel()
+        except Exception:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._kernels.append(kernel)
+        return kernel
+
+    def _release(self, kernel):
+        with self._condition:
+            # kernels of a pool which was shut down meanwhile are not reused
+            if kernel in self._kernels:
+                self._idle.append(kernel)
+                self._condition.notify()
+
+    def _discard(self, kernel):
+        with self._condition:
+            if kernel in self._kernels:
+                self._kernels.remove(kernel)
+                self._count -= 1
+                # a waiting thread starts the replacement
+                self._condition.notify()
+
+        kernel[1].stop_channels()
+        kernel[0].cleanup_resources()
+
+    @staged('start_kernel')
+    def _start_kernel(self):
+        from jupyter_client import KernelManager
+
+        km = KernelManager()
+        km.start_kernel(cwd=self._cwd, env=dict(os.environ, **instrumentation.get_environment()))
+
+        kc = km.client()
+        kc.start_channels()
+        if instrumentation.is_enabled():
+            _instrumented_kernels.add(kc)
+
+        try:
+            kc.wait_for_ready(timeout=STARTUP_TIMEOUT)
+            kc.execute_interactive(self._preload_code, timeout=STARTUP_TIMEOUT,
+                                   output_hook=lambda msg: None)
+        except Exception:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+            raise
+
+        return km, kc
+
+
+@contextmanager
+def collect_stages(kernel, name):
+    """Add the stages of the code executed in the (kernel manager, kernel client) tuple to the current profile.
+
+    If the instrumentation is disabled, it is disabled in the kernel as
+    well (pooled kernels may have been enabled for earlier notebooks).
+    """
+    kc = kernel[1]
+
+    if not instrumentation.is_enabled():
+        if kc in _instrumented_kernels:
+            kc.execute_interactive(DISABLE_CODE, timeout=STARTUP_TIMEOUT, output_hook=lambda msg: None)
+            _instrumented_kernels.discard(kc)
+        yield
+        return
+
+    kc.execute_interactive(COLLECT_CODE % (instrumentation.tracks_memory(), name),
+                           timeout=STARTUP_TIMEOUT, output_hook=lambda msg: None)
+    _instrumented_kernels.add(kc)
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        reply = kc.execute_interactive('', user_expressions={'events': COLLECTED_EXPRESSION},
+                                       timeout=STARTUP_TIMEOUT, output_hook=lambda msg: None)
+        result = reply['content'].get('user_expressions', {}).get('events', {})
+        if result.get('status') == 'ok':
+            # the expression value is the repr of the JSON string
+            instrumentation.add_events(ast.literal_eval(result['data']['text/plain']), start)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+
+import adicht
+from adicht.cache import file_digest, get_file_stamp, get_memoized_digest
+
+
+_code_version = None
+
+
+def get_code_version():
+    """Return a hash over the source code of the adicht package."""
+    global _code_version
+
+    if _code_version is None:
+        package_dir = os.path.dirname(adicht.__file__)
+        digest = hashlib.sha1()
+
+        for root, dirs, files in sorted(os.walk(package_dir)):
+            dirs.sort()
+            for entry in sorted(files):
+                if entry.endswith('.py'):
+                    path = os.path.join(root, entry)
+                    digest.update(os.path.relpath(path, package_dir).encode('utf-8'))
+                    digest.update(file_digest(path).encode('ascii'))
+
+        _code_version = digest.hexdigest()
+
+    return _code_version
+
+
+def get_rules_version(classifier=None):
+    """Return a hash over the rules of the classifier (by default the one set via ADICHT_MARKER_RULES)."""
+    from adicht.markers import get_default_classifier
+
+    rules = (classifier or get_default_classifier()).rules
+    return hashlib.sha1(repr([(category.name, pattern) for category, pattern in rules]).encode('utf-8')).hexdigest()
+
+
+class BuildManifest(object):
+    """Remembers the inputs the reports of a directory were built from.
+
+    Every report is stored with the hashes of its inputs (data file,
+    template, code version, ...). A report is up to date if these hashes did
+    not change and all of its output files exist.
+    """
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, directory):
+        self._path = os.path.join(directory, self.FILENAME)
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    @property
+    def path(self):
+        return self._path
+
+    def get_input_digest(self, data_file):
+        """Return the content hash of the data file.
+
+        The digest of the last build is reused if the file did not change
+        (see get_memoized_digest), update remembers it.
+        """
+        def lookup(stamp):
+            for entry in self._entries.values():
+                if entry.get('input_file') == data_file and entry.get('input_stamp') == stamp:
+                    return entry['hashes']['input']
+            return None
+
+        return get_memoized_digest(data_file, lookup)
+
+    def is_up_to_date(self, name, hashes, output_files):
+        entry = self._entries.get(name)
+
+        return entry is not None and entry['hashes'] == hashes \
+            and all(os.path.isfile(path) for path in output_files)
+
+    def update(self, name, hashes, data_file):
+        stamp = get_file_stamp(data_file)
+
+        with self._lock:
+            self._entries[name] = {
+                'hashes': hashes,
+                'input_file': data_file,
+                'input_stamp': stamp,
+            }
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+        tmp_path = '%s.tmp' % self._path
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
@@ -1,21 +1,22 @@
 # coding: utf-8
 
+from numpy import ravel
+
 from adicht.data import ADichtMatlabFile
 from adicht.display import display_table, display_markdown, display_html
 
 
 def generate_report(data_file_path):
-    data_file = ADichtMatlabFile(data_file_path)
-
-    display_markdown('# Raw Data Report\nData file: %s' % data_file_path)
-    display_html('<span style="font-weight:bold; color:red;">ATTENTION: Adicht/Matlab indices start at 1!</span>')
+    with ADichtMatlabFile(data_file_path, lazy=True) as data_file:
+        display_markdown('# Raw Data Report\nData file: %s' % data_file_path)
+        display_html('<span style="font-weight:bold; color:red;">ATTENTION: Adicht/Matlab indices start at 1!</span>')
 
-    report_block_information(data_file)
-    report_unit_information(data_file)
-    report_channel_information(data_file)
-    report_marker_information(data_file)
-    report_marker_text_information(data_file)
-    #report_raw_data_stream(data_file)
+        report_block_information(data_file)
+        report_unit_information(data_file)
+        report_channel_information(data_file)
+        report_marker_information(data_file)
+        report_marker_text_information(data_file)
+        #report_raw_data_stream(data_file)
 
 
 def report_block_information(data_file):
@@ -23,10 +24,10 @@ def report_block_information(data_file):
     display_table(
         [['Index', 'Time', 'Tick rate']]
         + [
-            [index, time[0], tickrate[0]]
+            [index, time, tickrate]
             for index, (time, tickrate) in enumerate(zip(
-                data_file.raw_content['blocktimes'],
-                data_file.raw_content['tickrate'],
+                ravel(data_file.raw_content['blocktimes']),
+                ravel(data_file.raw_content['tickrate']),
             ))
         ]
     )
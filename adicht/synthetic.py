@@ -0,0 +1,102 @@
+# coding: utf-8
+"""Generator for synthetic LabChart MAT exports (for benchmarks and experiments)."""
+
+import numpy
+
+from adicht.markers import STIMULATION_END_MARKER, INTEGRAL_END_MARKER
+
+
+STIMULATION_MARKER = 'el. stim %d'
+
+# MATLAB datenum of the recording start
+BLOCK_TIME = 737791.375
+
+STIMULATION_DURATION = 0.5
+INTEGRAL_DURATION = 1.5
+RESPONSE_TIME_CONSTANT = 0.15
+NOISE_LEVEL = 0.02
+
+
+def create_labchart_content(channels=2, duration=60.0, samplerate=1000.0, stimulations=10,
+                            seed=0, dtype='float32', blocks=1):
+    """Create the variables of a LabChart export.
+
+    Every channel contains noise on a slowly drifting baseline and an evoked
+    response to each of the (equidistant) stimulations. Per stimulation and
+    channel a stimulation marker, a stimulation end and an integral end
+    marker are set. duration and stimulations are per block, every block
+    has its own tick rate (the sample rate of the block). The result can be
+    written with scipy's savemat.
+    """
+    rng = numpy.random.default_rng(seed)
+
+    data = []
+    datastart = numpy.zeros((channels, blocks))
+    dataend = numpy.zeros((channels, blocks))
+    samplerates = numpy.zeros((channels, blocks))
+    com = []
+    comtext = [STIMULATION_END_MARKER, INTEGRAL_END_MARKER]
+
+    for i in range(stimulations):
+        comtext.append(STIMULATION_MARKER % (i + 1))
+
+    for block in range(blocks):
+        # later blocks are recorded with a different sample rate
+        block_samplerate = samplerate * (block + 1)
+        sample_count = int(duration * block_samplerate)
+        times = numpy.arange(sample_count) / block_samplerate
+        interval = duration / (stimulations + 1)
+        stimulation_times = interval * numpy.arange(1, stimulations + 1)
+
+        for channel in range(channels):
+            values = 0.1 * numpy.sin(2 * numpy.pi * times / duration + channel)
+            values += rng.normal(0, NOISE_LEVEL, sample_count)
+
+            for i, start in enumerate(stimulation_times):
+                # the response has decayed before the next stimulation
+                response = slice(int(start * block_samplerate), int((start + interval) * block_samplerate))
+                response_times = times[response] - start
+                amplitude = rng.uniform(0.5, 2.0)
+                values[response] += amplitude * response_times / RESPONSE_TIME_CONSTANT \
+                    * numpy.exp(1 - response_times / RESPONSE_TIME_CONSTANT)
+
+                # columns: channel, block, position (in ticks of the block), type, comtext index (all 1 based)
+                for offset, text_index in ((0.0, i + 3),
+                                           (STIMULATION_DURATION, 1),
+                                           (INTEGRAL_DURATION, 2)):
+                    com.append([channel + 1, block + 1, round((start + offset) * block_samplerate), 1,
+                                text_index])
+
+            position = sum(len(entry) for entry in data)
+            datastart[channel, block] = position + 1
+            dataend[channel, block] = position + sample_count
+            samplerates[channel, block] = block_samplerate
+            data.append(values)
+
+    return {
+        'data': numpy.concatenate(data).astype(dtype)[numpy.newaxis, :],
+        'datastart': datastart,
+        'dataend': dataend,
+        'titles': numpy.array(['Channel %d' % (channel + 1) for channel in range(channels)]),
+        'rangemin': numpy.full((channels, blocks), -10.0),
+        'rangemax': numpy.full((channels, blocks), 10.0),
+        'samplerate': samplerates,
+        'firstsampleoffset': numpy.zeros((channels, blocks)),
+        'unittext': numpy.array(['mV']),
+        'unittextmap': numpy.ones((channels, blocks)),
+        'tickrate': samplerates[:1].copy(),
+        # consecutive blocks, one minute apart
+        'blocktimes': BLOCK_TIME + numpy.arange(blocks)[numpy.newaxis, :] * (duration + 60) / 86400,
+        'com': numpy.array(com, dtype=float).reshape(-1, 5),
+        'comtext': numpy.array(comtext),
+    }
+
+
+def write_labchart_file(filename, channels=2, duration=60.0, samplerate=1000.0, stimulations=10,
+                        seed=0, dtype='float32', compress=False, blocks=1):
+    """Write a synthetic LabChart export (MAT v5) to filename, see create_labchart_content."""
+    from scipy.io import savemat
+
+    savemat(filename,
+            create_labchart_content(channels, duration, samplerate, stimulations, seed, dtype, blocks),
+            do_compression=compress)
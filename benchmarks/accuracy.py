@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# coding: utf-8
+"""Check the integrals of long float32 recordings against a float64 reference.
+
+The ChannelIntegrator takes differences of one cumulative integral over the
+whole channel, so late windows of long recordings are the ones which lose
+precision if the sum is not accumulated in float64.
+
+    python3 benchmarks/accuracy.py
+"""
+
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from adicht.evaluation import ChannelIntegrator, IntegralReference
+
+
+DURATION = 3600.0
+SAMPLERATE = 2000.0
+DC_LEVEL = 100.0
+WINDOW = 3000
+
+# maximum relative error of an integral
+TOLERANCE = 1e-9
+
+
+def create_recording(seed=0):
+    """Return a float32 recording with a DC level, noise and a few stimulation like bumps."""
+    generator = numpy.random.default_rng(seed)
+    count = int(DURATION * SAMPLERATE)
+    times = numpy.arange(count) / SAMPLERATE
+
+    data = DC_LEVEL + generator.normal(0, 0.5, count) + 20 * numpy.sin(times / 60.0) ** 8
+    return data.astype(numpy.float32)
+
+
+def get_reference(data, start, stop, reference):
+    """Integrate the samples [start, stop) in float64 without a cumulative sum."""
+    values = data[start:stop].astype(numpy.float64)
+    width = (stop - 1 - start) / SAMPLERATE
+    integral = numpy.sum((values[1:] + values[:-1]) / 2) / SAMPLERATE
+
+    if reference == IntegralReference.TO_BASELINE:
+        return integral - (values[0] + values[-1]) / 2 * width
+    return integral - values[0] * width
+
+
+def main():
+    data = create_recording()
+    integrator = ChannelIntegrator(data, SAMPLERATE)
+    failed = False
+
+    windows = [(0, WINDOW), (len(data) // 2, len(data) // 2 + WINDOW), (len(data) - 2 * WINDOW, len(data) - WINDOW)]
+
+    for start, stop in windows:
+        for name, reference in [('to start', IntegralReference.TO_START),
+                                ('to baseline', IntegralReference.TO_BASELINE)]:
+            expected = get_reference(data, start, stop, reference)
+            # relative to the integral without reference, which is dominated by the DC level
+            error = abs(integrator.integrate(start, stop, reference) - expected) / (DC_LEVEL * WINDOW / SAMPLERATE)
+            ok = error <= TOLERANCE
+            failed |= not ok
+
+            print('%s %.0f s, %s: relative error %.2e (tolerance %.0e)' % (
+                'OK  ' if ok else 'FAIL', start / SAMPLERATE, name, error, TOLERANCE))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
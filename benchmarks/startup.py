@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# coding: utf-8
+"""Check the import time of the adicht entry points against a startup budget.
+
+Every entry point is imported in a fresh interpreter with -X importtime.
+The check fails if an entry point exceeds its budget or imports one of the
+heavy modules it should only load on first use.
+
+    python3 benchmarks/startup.py
+"""
+
+import os
+import sys
+import subprocess
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY_MODULES = ['matplotlib', 'IPython', 'nbconvert', 'nbformat', 'nbclient', 'jinja2',
+                 'jupyter_client', 'scipy', 'h5py']
+
+# entry point module -> (budget in ms, modules which must not be imported)
+BUDGETS = {
+    'adicht.data': (300, HEAVY_MODULES),
+    'adicht.evaluation': (300, HEAVY_MODULES),
+    'adicht.display': (350, HEAVY_MODULES),
+    'adicht.report': (350, HEAVY_MODULES),
+    'adicht.batch': (150, HEAVY_MODULES),
+    # the module behind bin/adicht-eval, PyQt5 is needed to show the window
+    'adicht.gui.mainwindow': (800, HEAVY_MODULES),
+}
+
+
+def measure_import(module):
+    """Import the module in a new interpreter, return the import time (ms) and all imported modules."""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        cwd=SRC_DIR, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+
+    if process.returncode:
+        raise ImportError(process.stderr.strip().splitlines()[-1])
+
+    total = 0
+    imported = set()
+
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name_field = line[len('import time:'):].split('|')
+        name = name_field.strip()
+        imported.add(name)
+
+        # top level entries of the package contain the time of everything they import
+        top_level = len(name_field) - len(name_field.lstrip()) == 1
+        if top_level and (name == 'adicht' or name.startswith('adicht.')):
+            total += int(cumulative)
+
+    return total / 1000, imported
+
+
+def main():
+    failed = False
+
+    for module, (budget, forbidden) in sorted(BUDGETS.items()):
+        try:
+            duration, imported = measure_import(module)
+        except ImportError as e:
+            print('SKIP %s: %s' % (module, e))
+            continue
+
+        heavy = sorted(entry for entry in forbidden if entry in imported)
+        ok = duration <= budget and not heavy
+        failed |= not ok
+
+        print('%s %s: %.1f ms (budget %d ms)%s' % (
+            'OK  ' if ok else 'FAIL', module, duration, budget,
+            ', imports %s' % ', '.join(heavy) if heavy else ''))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+# coding: utf-8
+"""Time the main workloads on synthetic LabChart files and compare against baselines.
+
+The files are generated with adicht.synthetic (see WORKLOADS). Every
+benchmark is run a few times, the fastest run counts. A benchmark fails if
+it is slower than its recorded baseline by more than the tolerance.
+Baselines depend on the machine, record them before changing the code:
+
+    python3 benchmarks/suite.py --record
+    python3 benchmarks/suite.py
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+sys.path.insert(0, SRC_DIR)
+
+# workload name -> arguments of write_labchart_file
+WORKLOADS = {
+    'small': dict(channels=2, duration=60.0, samplerate=1000.0, stimulations=10),
+    'large': dict(channels=8, duration=600.0, samplerate=2000.0, stimulations=100),
+}
+
+REPEAT = 5
+TOLERANCE = 0.5
+# differences below this are considered noise (seconds)
+MIN_DIFFERENCE = 0.005
+
+
+def bench_load(path):
+    from adicht.data import ADichtMatlabFile
+
+    return lambda: ADichtMatlabFile(path, cache=False).channels
+
+
+def bench_time_axis(path):
+    from adicht.data import ADichtMatlabFile
+
+    channels = ADichtMatlabFile(path, cache=False).channels
+    return lambda: [channel.get_times() for channel in channels]
+
+
+def bench_extract_stimulations(path):
+    from adicht.data import ADichtMatlabFile
+    from adicht.evaluation import extract_stimulations
+
+    channels = ADichtMatlabFile(path, cache=False).channels
+    return lambda: [extract_stimulations(channel) for channel in channels]
+
+
+def bench_evaluate_stimulations(path):
+    from adicht.data import ADichtMatlabFile
+    from adicht.evaluation import get_evaluated_stimulations
+
+    channels = ADichtMatlabFile(path, cache=False).channels
+    return lambda: [get_evaluated_stimulations(channel) for channel in channels]
+
+
+def bench_parallel_evaluation(path):
+    from adicht.data import ADichtMatlabFile
+    from adicht.parallel import get_evaluated_channels
+
+    data_file = ADichtMatlabFile(path, cache=False)
+    return lambda: get_evaluated_channels(data_file, workers=os.cpu_count())
+
+
+def bench_features(path):
+    from adicht.data import ADichtMatlabFile
+    from adicht.features import extract_features
+
+    channels = ADichtMatlabFile(path, cache=False).channels
+    return lambda: [extract_features(channel) for channel in channels]
+
+
+def bench_plotting(path):
+    from adicht.data import ADichtMatlabFile
+    from adicht.display import display_channels, display_stimulations
+    from adicht.document import Document, render_to
+
+    data_file = ADichtMatlabFile(path, cache=False)
+
+    def run():
+        with render_to(Document('benchmark')):
+            display_channels(data_file)
+            display_stimulations(data_file)
+
+    return run
+
+
+def bench_report(path):
+    from adicht.report import Reporter
+
+    output_dir = os.path.join(os.path.dirname(path), 'reports')
+
+    def run():
+        with Reporter(output_dir, mode=Reporter.DIRECT_MODE, kernels=0) as reporter:
+            reporter.generate_report(path, force=True)
+
+    return run
+
+
+# benchmark name -> (setup function returning the timed callable, workloads)
+BENCHMARKS = {
+    'load': (bench_load, ['small', 'large']),
+    'time_axis': (bench_time_axis, ['small', 'large']),
+    'extract_stimulations': (bench_extract_stimulations, ['small', 'large']),
+    'evaluate_stimulations': (bench_evaluate_stimulations, ['small', 'large']),
+    'parallel_evaluation': (bench_parallel_evaluation, ['large']),
+    'features': (bench_features, ['small', 'large']),
+    'plotting': (bench_plotting, ['small']),
+    'report': (bench_report, ['small']),
+}
+
+
+def measure(func, repeat=REPEAT):
+    """Return the duration of the fastest of repeat calls of func (in seconds)."""
+    durations = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    return min(durations)
+
+
+def create_workloads(directory, names):
+    from adicht.synthetic import write_labchart_file
+
+    result = {}
+    for name in names:
+        result[name] = os.path.join(directory, '%s.mat' % name)
+        write_labchart_file(result[name], **WORKLOADS[name])
+    return result
+
+
+def load_baselines():
+    try:
+        with open(BASELINE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baselines(baselines):
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def create_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run (default: all of %s)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--record', action='store_true',
+                        help='store the results as new baselines')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='number of runs per benchmark (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed slowdown relative to the baseline (default: %(default)s)')
+    return parser
+
+
+def main(args=None):
+    args = create_argument_parser().parse_args(args)
+    names = args.benchmarks or sorted(BENCHMARKS)
+
+    unknown = [entry for entry in names if entry not in BENCHMARKS]
+    if unknown:
+        print('unknown benchmarks: %s' % ', '.join(unknown))
+        return 2
+
+    # benchmarks measure the parsing, not the cache
+    os.environ['ADICHT_CACHE'] = '0'
+
+    baselines = load_baselines()
+    failed = False
+    directory = tempfile.mkdtemp(prefix='adicht-benchmark-')
+
+    try:
+        files = create_workloads(directory, sorted({
+            workload for name in names for workload in BENCHMARKS[name][1]}))
+
+        for name in names:
+            setup, workloads = BENCHMARKS[name]
+
+            for workload in workloads:
+                key = '%s[%s]' % (name, workload)
+                duration = measure(setup(files[workload]), args.repeat)
+                baseline = baselines.get(key)
+
+                if args.record:
+                    baselines[key] = round(duration, 6)
+                    print('REC  %s: %.1f ms' % (key, duration * 1000))
+                    continue
+
+                if baseline is None:
+                    print('NEW  %s: %.1f ms (no baseline)' % (key, duration * 1000))
+                    continue
+
+                ok = duration <= baseline * (1 + args.tolerance) or duration - baseline < MIN_DIFFERENCE
+                failed |= not ok
+                print('%s %s: %.1f ms (baseline %.1f ms, %+.0f%%)' % (
+                    'OK  ' if ok else 'FAIL', key, duration * 1000, baseline * 1000,
+                    (duration / baseline - 1) * 100))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.record:
+        save_baselines(baselines)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())